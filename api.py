@@ -1,5 +1,18 @@
+import argparse
+import os
+import random
+import threading
+import time
 import requests
 import json
+from datetime import datetime, timedelta, timezone
+from math import ceil
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from catalogue import open_snapshot
+from thumbnails import ThumbnailCache, prefetch
+from snapshot_db import DATABASE_FILE, build_database
 
 with open("data.txt", "r") as file:
     BASE_URL = file.readline().strip()
@@ -11,109 +24,646 @@ HEADERS = {
     "Accept": "application/json"
 }
 
+DATA_FILE = "all_items.json"
+SCRAPE_DIR = "scrape"  # per-library JSON Lines files the snapshot is assembled from
+MANIFEST_FILE = os.path.join(SCRAPE_DIR, "manifest.json")
+CHECKPOINT_FILE = os.path.join(SCRAPE_DIR, "checkpoint.json")
+PAGE_SIZE = 500
+ID_PAGE_SIZE = 5000
+SYNC_OVERLAP = timedelta(minutes=10)  # covers clock skew between us and the server
+MAX_WORKERS = 4  # parallel page requests per library, keep low for small servers
+LIBRARY_WORKERS = 3  # libraries scraped at the same time
+PAGE_WORKERS = MAX_WORKERS  # raised by set_max_requests() so --max-requests can be reached
+
+# Global budget shared by every library, see RequestBudget
+MAX_REQUESTS = 8
+START_REQUESTS = 4
+SLOW_REQUEST = 5.0  # seconds, slower responses count as the server struggling
+
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=MAX_REQUESTS))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=MAX_REQUESTS))
+
+CHECKPOINT_LOCK = threading.RLock()
+
+
+# =====================
+# Requests
+# =====================
+
+class RequestBudget:
+    """
+    Caps the requests in flight across all libraries. The cap adapts AIMD
+    style: it grows by one after a full window of fast successes and halves
+    (at most once per SLOW_REQUEST seconds) on an error, retryable status or
+    slow response, so we back off while the server is struggling.
+    """
+
+    def __init__(self, start, maximum, minimum=1):
+        self.limit = start
+        self.maximum = maximum
+        self.minimum = minimum
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if not ok or latency > SLOW_REQUEST:
+                self.successes = 0
+                if now - self.last_decrease > SLOW_REQUEST and self.limit > self.minimum:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.last_decrease = now
+                    print(f"  Server under pressure, concurrency down to {self.limit}")
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+BUDGET = RequestBudget(START_REQUESTS, MAX_REQUESTS)
+
+
+def set_max_requests(maximum):
+    """
+    Applies --max-requests to the budget, to the connection pool (so every
+    request in flight can keep its connection) and to the page workers per
+    library (so the libraries together can have that many requests going).
+    """
+    global PAGE_WORKERS
+    BUDGET.maximum = max(1, maximum)
+    BUDGET.limit = min(BUDGET.limit, BUDGET.maximum)
+    SESSION.mount("http://", HTTPAdapter(pool_maxsize=BUDGET.maximum))
+    SESSION.mount("https://", HTTPAdapter(pool_maxsize=BUDGET.maximum))
+    PAGE_WORKERS = max(MAX_WORKERS, ceil(BUDGET.maximum / LIBRARY_WORKERS))
+
+
+def backoff_delay(attempt, response=None):
+    """Exponential backoff with full jitter, honouring Retry-After when the server sends one"""
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def api_get(path, params=None, timeout=30):
+    """GET a JSON endpoint inside the global budget, retrying 429/5xx and timeouts"""
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        BUDGET.acquire()
+        started = time.monotonic()
+        try:
+            response = SESSION.get(f"{BASE_URL}{path}", params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            BUDGET.release(time.monotonic() - started, ok=False)
+            error = e
+        else:
+            retry = response.status_code in RETRY_STATUSES
+            BUDGET.release(time.monotonic() - started, ok=not retry)
+            if not retry:
+                response.raise_for_status()
+                return response.json()
+            error = requests.HTTPError(f"{response.status_code} for {path}", response=response)
+
+        if attempt == MAX_RETRIES:
+            raise error
+        delay = backoff_delay(attempt, response)
+        print(f"  Retrying {path} in {delay:.1f}s ({error})")
+        time.sleep(delay)
+
 
 # =====================
 # User & Libraries
 # =====================
 
 def get_user_id():
-    r = requests.get(f"{BASE_URL}/Users", headers=HEADERS, timeout=10)
-    r.raise_for_status()
-    for user in r.json():
+    for user in api_get("/Users", timeout=10):
         if user.get("Name") == USERNAME:
             return user["Id"]
     raise RuntimeError("User not found")
 
 
 def get_libraries(user_id):
-    r = requests.get(
-        f"{BASE_URL}/Users/{user_id}/Views",
-        headers=HEADERS,
-        timeout=10
-    )
-    r.raise_for_status()
-    return r.json().get("Items", [])
+    return api_get(f"/Users/{user_id}/Views", timeout=10).get("Items", [])
 
 
 # =====================
 # Items per Library
 # =====================
 
-def get_library_items(user_id, library_id):
-    items = []
-    start_index = 0
-    limit = 500
-
-    while True:
-        params = {
-            "ParentId": library_id,
-            "Recursive": "true",
-            "StartIndex": start_index,
-            "Limit": limit,
-            # Request EVERYTHING useful
+def get_library_page(user_id, library_id, start_index, limit=PAGE_SIZE, extra_params=None):
+    params = {
+        "ParentId": library_id,
+        "Recursive": "true",
+        "StartIndex": start_index,
+        "Limit": limit,
+        # Request EVERYTHING useful
+        "Fields": (
+            "Id,Name,Type,Path,ParentId,IndexNumber,"
+            "ParentIndexNumber,SeriesId,SeasonId,Container,"
+            "MediaType,LocationType"
+        )
+    }
+    if extra_params:
+        params.update(extra_params)
+
+    return api_get(f"/Users/{user_id}/Items", params=params, timeout=30)
+
+
+# What each collection type needs, in passes. Each pass only asks for the
+# item types the web views use and the fields they read; Name, Id, Type and
+# ImageTags always come back. Deferred passes hold the heavy child types
+# (tracks, episodes, books) and can be skipped with --shallow.
+QUERY_PLANS = {
+    "movies": [
+        {"IncludeItemTypes": "Movie", "Fields": "Path,Container,LocationType,DateCreated"},
+    ],
+    "tvshows": [
+        {"IncludeItemTypes": "Series,Season", "Fields": "ParentId,IndexNumber,DateCreated"},
+        {
+            "IncludeItemTypes": "Episode",
             "Fields": (
-                "Id,Name,Type,Path,ParentId,IndexNumber,"
-                "ParentIndexNumber,SeriesId,SeasonId,Container,"
-                "MediaType,LocationType"
-            )
-        }
+                "Path,ParentId,IndexNumber,ParentIndexNumber,"
+                "SeriesId,SeasonId,Container,LocationType"
+            ),
+            "Deferred": True
+        },
+    ],
+    "books": [
+        {"IncludeItemTypes": "Folder", "Fields": "ParentId,DateCreated"},
+        {"IncludeItemTypes": "Book", "Fields": "Path,ParentId,Container", "Deferred": True},
+    ],
+    "music": [
+        {"IncludeItemTypes": "MusicAlbum", "Fields": "ParentId,DateCreated"},
+        {
+            "IncludeItemTypes": "Audio",
+            "Fields": "Path,ParentId,AlbumId,IndexNumber,Container",
+            "Deferred": True
+        },
+    ],
+    "musicvideos": [
+        {"IncludeItemTypes": "Folder", "Fields": "ParentId,DateCreated"},
+        {
+            "IncludeItemTypes": "MusicVideo,Video",
+            "Fields": "Path,ParentId,Container,LocationType",
+            "Deferred": True
+        },
+    ],
+}
 
-        r = requests.get(
-            f"{BASE_URL}/Users/{user_id}/Items",
-            headers=HEADERS,
-            params=params,
-            timeout=30
-        )
-        r.raise_for_status()
+# Applied to every planned pass, the views only ever show the Primary image
+PLAN_PARAMS = {
+    "EnableUserData": "false",
+    "EnableImageTypes": "Primary",
+    "ImageTypeLimit": 1
+}
+
+
+def query_plan(collection_type, shallow=False):
+    """
+    Returns the list of extra_params (one per pass) to scrape a library with.
+    Unknown collection types get a single pass with the broad default query.
+    """
+    plan = QUERY_PLANS.get(collection_type)
+    if plan is None:
+        return [{}]
+
+    passes = []
+    for step in plan:
+        if shallow and step.get("Deferred"):
+            continue
+        params = dict(PLAN_PARAMS)
+        params.update((key, value) for key, value in step.items() if key != "Deferred")
+        passes.append(params)
+    return passes
+
+
+def iter_library_pages(user_id, library_id, max_workers=None,
+                       page_size=PAGE_SIZE, extra_params=None, start_index=0):
+    """
+    Yields the library in server order, one page at a time, as (start index
+    of the next page, list of items). Pages after the first are fixed
+    windows, so the next start comes from the window and not from how many
+    items a page happened to hold (the server may filter some out).
+    """
+    if max_workers is None:
+        max_workers = PAGE_WORKERS
+
+    data = get_library_page(user_id, library_id, start_index, page_size, extra_params)
+    batch = data.get("Items", [])
+    if not batch:
+        return
+    yield start_index + len(batch), batch
+
+    total = data.get("TotalRecordCount", 0)
+    # The server may cap Limit below page_size, so step by what it really sent
+    step = min(len(batch), page_size)
+    starts = range(start_index + len(batch), total, step)
+
+    if max_workers <= 1:
+        for start_index in starts:
+            batch = get_library_page(
+                user_id, library_id, start_index, step, extra_params
+            ).get("Items", [])
+            if not batch:
+                return
+            yield start_index + step, batch
+        return
+
+    # Keep a bounded window of requests in flight and hand pages back in order
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        starts = iter(starts)
+
+        def submit_next():
+            start_index = next(starts, None)
+            if start_index is not None:
+                pending.append((start_index, pool.submit(
+                    get_library_page, user_id, library_id, start_index, step, extra_params
+                )))
+
+        for _ in range(max_workers * 2):
+            submit_next()
+
+        while pending:
+            start_index, future = pending.popleft()
+            batch = future.result().get("Items", [])
+            submit_next()
+            if batch:
+                yield start_index + step, batch
 
-        data = r.json()
-        batch = data.get("Items", [])
-        if not batch:
-            break
 
+def get_library_items(user_id, library_id, max_workers=None, extra_params=None):
+    items = []
+    for _, batch in iter_library_pages(user_id, library_id, max_workers, extra_params=extra_params):
         items.extend(batch)
-        start_index += len(batch)
+    return items
 
-        if start_index >= data.get("TotalRecordCount", 0):
-            break
 
+# =====================
+# Incremental sync
+# =====================
+
+def get_changed_items(user_id, library_id, since, passes=({},)):
+    """Items added or modified on the server since the given datetime"""
+    items = []
+    for params in passes:
+        params = dict(params, MinDateLastSaved=format_sync_time(since - SYNC_OVERLAP))
+        items.extend(get_library_items(user_id, library_id, extra_params=params))
     return items
 
 
+def get_library_ids(user_id, library_id, passes=({},)):
+    """Cheap listing of every Id currently in the library (no fields, images or user data)"""
+    ids = set()
+    extra_params = {
+        "Fields": "",
+        "EnableImages": "false",
+        "EnableUserData": "false"
+    }
+    # Only list the item types the plan keeps, unless some pass takes everything
+    if all(params.get("IncludeItemTypes") for params in passes):
+        extra_params["IncludeItemTypes"] = ",".join(params["IncludeItemTypes"] for params in passes)
+    for _, batch in iter_library_pages(user_id, library_id, page_size=ID_PAGE_SIZE,
+                                    extra_params=extra_params):
+        ids.update(item["Id"] for item in batch)
+    return ids
+
+
+def merge_library(library_id, changed_items, live_ids):
+    """
+    Streams the stored library through, replacing changed items by Id and
+    dropping items no longer on the server. Returns (item count, removed count).
+    """
+    changed = {item["Id"]: item for item in changed_items}
+    count = removed = 0
+
+    with open(library_path(library_id), "r", encoding="utf-8") as old, \
+            open(library_path(library_id) + ".part", "w", encoding="utf-8") as out:
+        for line in old:
+            item_id = json.loads(line)["Id"]
+            if item_id not in live_ids:
+                removed += 1
+                continue
+            if item_id in changed:
+                line = json.dumps(changed.pop(item_id), ensure_ascii=False) + "\n"
+            out.write(line)
+            count += 1
+
+        for item_id, item in changed.items():
+            if item_id in live_ids:
+                out.write(json.dumps(item, ensure_ascii=False) + "\n")
+                count += 1
+
+    os.replace(library_path(library_id) + ".part", library_path(library_id))
+    return count, removed
+
+
+def format_sync_time(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_sync_time(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+
+# =====================
+# Snapshot storage
+# =====================
+
+def library_path(library_id):
+    return os.path.join(SCRAPE_DIR, f"{library_id}.jsonl")
+
+
+def scrape_library(user_id, library_id, checkpoint, passes=({},)):
+    """
+    Writes every page to disk as it arrives, so memory stays at one page per
+    request in flight, and checkpoints after each page. A library that has
+    progress in the checkpoint continues from its last committed page.
+    """
+    part = library_path(library_id) + ".part"
+    state = checkpoint["Libraries"][library_id]
+    if not os.path.exists(part):
+        with CHECKPOINT_LOCK:
+            state.update(Pass=0, StartIndex=0, Pages=0, Count=0, Offset=0)
+
+    with open(part, "r+b" if state["Offset"] else "wb") as out:
+        # Drop anything written after the last checkpoint
+        out.seek(state["Offset"])
+        out.truncate()
+
+        while state["Pass"] < len(passes):
+            for next_start, batch in iter_library_pages(
+                user_id, library_id,
+                extra_params=passes[state["Pass"]],
+                start_index=state["StartIndex"]
+            ):
+                out.write("".join(json.dumps(item, ensure_ascii=False) + "\n" for item in batch).encode("utf-8"))
+                out.flush()
+
+                # Together, so another library's save never catches half of it
+                with CHECKPOINT_LOCK:
+                    state["StartIndex"] = next_start
+                    state["Count"] += len(batch)
+                    state["Pages"] += 1
+                    state["Offset"] = out.tell()
+                    save_checkpoint(checkpoint)
+
+            with CHECKPOINT_LOCK:
+                state["Pass"] += 1
+                state["StartIndex"] = 0
+                save_checkpoint(checkpoint)
+
+    os.replace(part, library_path(library_id))
+    return state["Count"]
+
+
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_json(path, data):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def load_manifest():
+    return _load_json(MANIFEST_FILE, {})
+
+
+def save_manifest(manifest):
+    _save_json(MANIFEST_FILE, manifest)
+
+
+def load_checkpoint():
+    """
+    Progress of the current run: manifest entries of finished libraries and,
+    per library in progress, its sync time, query plan pass, next StartIndex
+    within that pass, pages and items saved and the byte offset of the .part
+    file at the last committed page.
+    """
+    return _load_json(CHECKPOINT_FILE, {"Manifest": {}, "Libraries": {}})
+
+
+def save_checkpoint(checkpoint):
+    # Libraries are scraped in parallel, all sharing one checkpoint
+    with CHECKPOINT_LOCK:
+        _save_json(CHECKPOINT_FILE, checkpoint)
+
+
+def write_snapshot(manifest, path=DATA_FILE, indent=None):
+    """
+    Assembles all_items.json from the per-library files one item at a time
+    and swaps it in with an atomic rename, so readers never see a half file.
+    """
+    def newline(level):
+        return "\n" + " " * (indent * level) if indent else ""
+
+    def dump(value, level):
+        return json.dumps(value, indent=indent, ensure_ascii=False).replace("\n", newline(level))
+
+    with open(path + ".tmp", "w", encoding="utf-8") as out:
+        out.write("{")
+        for n, (library_id, lib) in enumerate(manifest.items()):
+            if n:
+                out.write(",")
+            out.write(newline(1) + dump(lib["Name"], 1) + ": {")
+
+            header = {
+                "LibraryId": library_id,
+                "CollectionType": lib.get("CollectionType"),
+                "LastSync": lib.get("LastSync")
+            }
+            for key, value in header.items():
+                out.write(newline(2) + dump(key, 2) + ": " + dump(value, 2) + ",")
+            out.write(newline(2) + '"Items": [')
+
+            with open(library_path(library_id), "r", encoding="utf-8") as items:
+                for i, line in enumerate(items):
+                    if i:
+                        out.write(",")
+                    # Compact lines are already valid JSON, only re-encode to indent them
+                    out.write(newline(3) + (dump(json.loads(line), 3) if indent else line.rstrip("\n")))
+            out.write(newline(2) + "]" + newline(1) + "}")
+        out.write(newline(0) + "}")
+
+    os.replace(path + ".tmp", path)
+
+
+def remove_stale_libraries(manifest):
+    """Deletes stored files of libraries that no longer exist on the server"""
+    for filename in os.listdir(SCRAPE_DIR):
+        library_id, ext = os.path.splitext(filename)
+        if ext == ".jsonl" and library_id not in manifest:
+            os.remove(os.path.join(SCRAPE_DIR, filename))
+
+
 # =====================
 # Main
 # =====================
 
+def sync_library(user_id, lib, previous, checkpoint, shallow=False):
+    """Scrapes, resumes or incrementally syncs one library and returns its manifest entry"""
+    lib_id = lib["Id"]
+    lib_name = lib.get("Name", "Unknown")
+    passes = query_plan(lib.get("CollectionType"), shallow)
+
+    with CHECKPOINT_LOCK:
+        state = checkpoint["Libraries"].setdefault(lib_id, {
+            "SyncTime": format_sync_time(datetime.now(timezone.utc)),
+            "Pass": 0,
+            "StartIndex": 0,
+            "Pages": 0,
+            "Count": 0,
+            "Offset": 0
+        })
+
+    old = previous.get(lib_id)
+    if old and old.get("LastSync") and os.path.exists(library_path(lib_id)):
+        print(f"Syncing library: {lib_name} (changes since {old['LastSync']})")
+        changed = get_changed_items(user_id, lib_id, parse_sync_time(old["LastSync"]), passes)
+        # List every planned type even when shallow, or stored deferred items look deleted
+        live_ids = get_library_ids(user_id, lib_id, query_plan(lib.get("CollectionType")))
+        count, removed = merge_library(lib_id, changed, live_ids)
+        print(f"  {lib_name}: changed {len(changed)}, removed {removed}")
+    elif state["Pages"]:
+        print(f"Resuming library: {lib_name} (from item {state['Count']}, {state['Pages']} pages saved)")
+        count = scrape_library(user_id, lib_id, checkpoint, passes)
+    else:
+        print(f"Scraping library: {lib_name}")
+        count = scrape_library(user_id, lib_id, checkpoint, passes)
+
+    print(f"  {lib_name}: {count} items found")
+
+    return {
+        "Name": lib_name,
+        "CollectionType": lib.get("CollectionType"),
+        "LastSync": state["SyncTime"],
+        "Count": count
+    }
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Scrape Jellyfin libraries into all_items.json")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only fetch items changed since the last sync and merge them into the existing snapshot"
+    )
+    parser.add_argument(
+        "--indent",
+        type=int,
+        default=None,
+        help="pretty-print all_items.json with this indent (default: compact)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run: skip finished libraries and resume from the last saved page"
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=MAX_REQUESTS,
+        help=f"upper bound on concurrent requests to the server (default: {MAX_REQUESTS})"
+    )
+    parser.add_argument(
+        "--shallow",
+        action="store_true",
+        help="skip the deferred passes (episodes, tracks, books, videos); only the top-level listing pages will have data"
+    )
+    parser.add_argument(
+        "--database",
+        action="store_true",
+        help=f"also build {DATABASE_FILE} for multi-process serving (rebuilt automatically once it exists)"
+    )
+    parser.add_argument(
+        "--thumbnails",
+        action="store_true",
+        help="afterwards, fetch every cover the web app will show into its thumbnail cache"
+    )
+    args = parser.parse_args()
+
+    set_max_requests(args.max_requests)
+
+    os.makedirs(SCRAPE_DIR, exist_ok=True)
+
     user_id = get_user_id()
     print("UserId:", user_id)
 
     libraries = get_libraries(user_id)
     print(f"Libraries found: {len(libraries)}\n")
 
-    all_data = {}
+    previous = load_manifest() if args.incremental else {}
+
+    if args.resume:
+        checkpoint = load_checkpoint()
+    else:
+        checkpoint = {"Manifest": {}, "Libraries": {}}
+        save_checkpoint(checkpoint)
+    done = checkpoint["Manifest"]
 
     for lib in libraries:
-        lib_id = lib["Id"]
-        lib_name = lib.get("Name", "Unknown")
+        if lib["Id"] in done:
+            print(f"Already scraped, skipping: {lib.get('Name', 'Unknown')}")
 
-        print(f"Scraping library: {lib_name}")
+    failed = []
+    with ThreadPoolExecutor(max_workers=LIBRARY_WORKERS) as pool:
+        futures = {
+            pool.submit(sync_library, user_id, lib, previous, checkpoint, args.shallow): lib
+            for lib in libraries if lib["Id"] not in done
+        }
+        for future in as_completed(futures):
+            lib = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f"Library failed: {lib.get('Name', 'Unknown')}: {e}")
+                failed.append(lib)
+                continue
 
-        items = get_library_items(user_id, lib_id)
+            with CHECKPOINT_LOCK:
+                done[lib["Id"]] = entry
+                del checkpoint["Libraries"][lib["Id"]]
+                save_checkpoint(checkpoint)
 
-        print(f"  Items found: {len(items)}")
+    if failed:
+        raise SystemExit(f"\n{len(failed)} libraries failed, run again with --resume to continue")
 
-        all_data[lib_name] = {
-            "LibraryId": lib_id,
-            "CollectionType": lib.get("CollectionType"),
-            "Items": items
-        }
+    manifest = {lib["Id"]: done[lib["Id"]] for lib in libraries}
+    save_manifest(manifest)
+    remove_stale_libraries(manifest)
+    write_snapshot(manifest, indent=args.indent)
+    os.remove(CHECKPOINT_FILE)
+
+    print(f"\nSaved ALL libraries to {DATA_FILE}")
 
-    # Save everything
-    with open("all_items.json", "w", encoding="utf-8") as f:
-        json.dump(all_data, f, indent=2, ensure_ascii=False)
+    if args.database or os.path.exists(DATABASE_FILE):
+        build_database(open_snapshot(MANIFEST_FILE))
+        print(f"Saved {DATABASE_FILE}")
 
-    print("\nSaved ALL libraries to all_items.json")
+    if args.thumbnails:
+        prefetch(ThumbnailCache(BASE_URL, API_KEY), open_snapshot(MANIFEST_FILE))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+"""
+End-to-end scrape/download benchmark against mock_server.py.
+
+Starts the mock server in a subprocess, runs api.main() and a batch of
+downloads from a scratch directory, then reports scrape items/sec,
+download MB/s and peak RSS of this process.
+
+    python benchmark.py --movies 100000 --latency 20 --downloads 8 --bandwidth 20
+"""
+
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("mock server did not start")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def pick_episodes(count):
+    """Reads the scraped TV library line by line until it has enough episodes"""
+    manifest = json.load(open(os.path.join("scrape", "manifest.json"), encoding="utf-8"))
+    episodes = []
+    for library_id, lib in manifest.items():
+        if lib.get("CollectionType") != "tvshows":
+            continue
+        with open(os.path.join("scrape", f"{library_id}.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                item = json.loads(line)
+                if item.get("Type") == "Episode":
+                    episodes.append(item)
+                    if len(episodes) == count:
+                        return episodes
+    return episodes
+
+
+def run_downloads(download, episodes, target):
+    for ep in episodes:
+        download.SCHEDULER.submit(ep, target, download.PRIORITY_SEASON)
+    download.SCHEDULER.join()
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+def main():
+    parser = mock_server.build_parser()
+    parser.description = "Scrape/download benchmark against the mock Jellyfin server"
+    parser.add_argument("--downloads", type=int, default=4, help="episodes to download (0 to skip)")
+    parser.add_argument("--scrape-args", default="",
+                        help="extra arguments for api.main, e.g. \"--max-requests 16\"")
+    args = parser.parse_args()
+    args.port = free_port()
+
+    # Hand every mock_server option through to the subprocess
+    server_args = []
+    for name in vars(mock_server.build_parser().parse_args([])):
+        server_args += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mock_server.py"), *server_args],
+        stdout=subprocess.DEVNULL
+    )
+    try:
+        wait_for_port(args.port)
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            with open("data.txt", "w") as f:
+                f.write(f"http://127.0.0.1:{args.port}\n{mock_server.API_KEY}\n{mock_server.USERNAME}\n")
+
+            sys.path.insert(0, HERE)
+            import api
+            import download
+
+            sys.argv = ["api.py", *args.scrape_args.split()]
+            started = time.perf_counter()
+            api.main()
+            scrape_time = time.perf_counter() - started
+            items = sum(lib["Count"] for lib in api.load_manifest().values())
+            scrape_rss = peak_rss_mb()
+
+            download_time = downloaded = 0
+            if args.downloads:
+                episodes = pick_episodes(args.downloads)
+                target = os.path.join(workdir, "downloads")
+                os.makedirs(target)
+                started = time.perf_counter()
+                run_downloads(download, episodes, target)
+                download_time = time.perf_counter() - started
+                downloaded = directory_size(target)
+
+            os.chdir(HERE)
+
+        print("\n===== Benchmark =====")
+        print(f"Scrape:    {items} items in {scrape_time:.2f}s = {items / scrape_time:,.0f} items/s")
+        if args.downloads:
+            mb = downloaded / 1024 / 1024
+            print(f"Download:  {mb:.1f} MB in {download_time:.2f}s = {mb / download_time:.1f} MB/s")
+        print(f"Peak RSS:  {scrape_rss:.1f} MB after scrape, {peak_rss_mb():.1f} MB overall")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
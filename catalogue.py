@@ -0,0 +1,671 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from search import SearchIndex
+
+RELOAD_INTERVAL = 5  # seconds between checks for a new all_items.json
+DIGITS_RE = re.compile(r"(\d+)")
+
+
+# =====================
+# Compact items
+# =====================
+
+# Item fields kept in slots, everything else goes into Item._extra
+ITEM_FIELDS = (
+    "Id", "Name", "SortName", "Type", "ParentId", "SeriesId", "SeasonId", "AlbumId",
+    "IndexNumber", "ParentIndexNumber", "Path", "Container", "MediaType", "LocationType",
+    "DateCreated", "DateLastSaved", "ImageUrl",
+)
+SLOT_FIELDS = frozenset(ITEM_FIELDS)
+# Fields whose strings are shared between items: enum-like values (Type,
+# Container, ...) and parent Ids that repeat an Id already in memory
+SHARED_FIELDS = frozenset((
+    "Type", "Container", "MediaType", "LocationType",
+    "Id", "ParentId", "SeriesId", "SeasonId", "AlbumId",
+))
+# Sent by the server but never read by the web app
+DROPPED_FIELDS = frozenset(("ImageBlurHashes", "ServerId"))
+
+_MISSING = object()
+
+
+class Item:
+    """
+    A catalogue item stored in slots rather than as its own dict, with shared
+    strings for repeated values. It reads like the dict it was parsed from:
+    item["Name"], item.get("Container"), "Path" in item, dict(item), and
+    item.Name in templates. Items are shared between requests, use replace()
+    to get a changed copy.
+    """
+
+    __slots__ = ITEM_FIELDS + ("_primary_tag", "_extra")
+
+    def __init__(self, pairs, strings=None):
+        extra = None
+        for key, value in pairs:
+            if key in SLOT_FIELDS:
+                if key in SHARED_FIELDS and strings is not None and value.__class__ is str:
+                    value = strings.setdefault(value, value)
+                setattr(self, key, value)
+            elif key == "ImageTags" and value and len(value) == 1 and "Primary" in value:
+                self._primary_tag = value["Primary"]
+            elif key not in DROPPED_FIELDS:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._extra = extra
+
+    def get(self, key, default=None):
+        if key in SLOT_FIELDS:
+            return getattr(self, key, default)
+        if key == "ImageTags" and hasattr(self, "_primary_tag"):
+            return {"Primary": self._primary_tag}
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __getitem__(self, key):
+        if key in SLOT_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self):
+        keys = [key for key in ITEM_FIELDS if hasattr(self, key)]
+        if hasattr(self, "_primary_tag"):
+            keys.append("ImageTags")
+        if self._extra is not None:
+            keys.extend(self._extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def replace(self, **fields):
+        """A copy with some fields set, e.g. item.replace(ImageUrl=...)"""
+        copy = Item.__new__(Item)
+        for key in Item.__slots__:
+            value = getattr(self, key, _MISSING)
+            if value is not _MISSING:
+                setattr(copy, key, value)
+        for key, value in fields.items():
+            if key in SLOT_FIELDS:
+                setattr(copy, key, value)
+            else:
+                copy._extra = dict(copy._extra or {}, **{key: value})
+        return copy
+
+    def __repr__(self):
+        return f"Item({dict(self)!r})"
+
+
+def item_hook(strings):
+    """
+    json.load() object_hook that turns each item's dict into an Item as soon
+    as it's parsed, so no dict per item is kept. `strings` is shared by the
+    whole snapshot.
+    """
+    def hook(value):
+        if "Id" in value and "Type" in value:
+            return Item(value.items(), strings)
+        return value
+    return hook
+
+
+# =====================
+# Indexed libraries
+# =====================
+
+class Library:
+    """
+    One library of the snapshot with the lookups the routes need, built in a
+    single pass when the snapshot loads: Id -> item, ParentId -> children and
+    Type -> items. Lists keep the order the scraper wrote the items in.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.library_id = data.get("LibraryId")
+        self.collection_type = data.get("CollectionType")
+        self.items = data.get("Items", [])
+
+        self.by_id = {}
+        self.children = defaultdict(list)
+        self.by_type = defaultdict(list)
+
+        # Derived views, built on first use. They live and die with this
+        # object, so a new snapshot starts with an empty cache.
+        self._hierarchy = None
+        self._reverse_index = None
+        self._listings = {}
+        self._positions = {}
+        self._covers = None
+        self._lock = threading.RLock()
+
+        for item in self.items:
+            self.by_id[item["Id"]] = item
+            if item.get("ParentId"):
+                self.children[item["ParentId"]].append(item)
+            self.by_type[item.get("Type")].append(item)
+
+    def get(self, item_id, *types):
+        """The item with this Id, or None if it's missing or not one of the given types"""
+        item = self.by_id.get(item_id)
+        if item is None or (types and item.get("Type") not in types):
+            return None
+        return item
+
+    def children_of(self, parent_id, *types):
+        children = self.children.get(parent_id, [])
+        if types:
+            return [item for item in children if item.get("Type") in types]
+        return children
+
+    def of_type(self, *types):
+        if len(types) == 1:
+            return self.by_type.get(types[0], [])
+        return [item for item_type in types for item in self.by_type.get(item_type, [])]
+
+
+    def covers(self):
+        """Item Id -> (Id of the item whose Primary image to show, image tag), see build_covers()"""
+        if self._covers is None:
+            with self._lock:
+                if self._covers is None:
+                    self._covers = build_covers(self)
+        return self._covers
+
+    def cover(self, item):
+        """Where to get this item's artwork: (image item Id, tag), or None if nothing has any"""
+        covers = self.covers()
+        cover = covers.get(item["Id"])
+        if cover is None and item["Id"] not in self.by_id:
+            # Made-up items (pseudo seasons) borrow their parent's cover
+            cover = covers.get(item.get("ParentId"))
+        return cover
+
+    def listing(self, key, build=None):
+        """
+        A derived, ordered list of items, built by build() (by default the
+        LISTINGS entry for `key`) once per snapshot and cached as `key`
+        """
+        items = self._listings.get(key)
+        if items is None:
+            with self._lock:
+                items = self._listings.get(key)
+                if items is None:
+                    items = self._listings[key] = build() if build else LISTINGS[key](self)
+        return items
+
+    def positions(self, key):
+        """Id -> index in the listing `key` (or in the Type list `key` if there's no such listing)"""
+        positions = self._positions.get(key)
+        if positions is None:
+            items = self._listings.get(key)
+            if items is None:
+                items = self.of_type(key)
+            positions = {item["Id"]: i for i, item in enumerate(items)}
+            self._positions[key] = positions
+        return positions
+
+    def sorted_listing(self, key, sort, descending=False, container=None):
+        """
+        The listing `key` (a LISTINGS name or a Type) in a SORT_KEYS order
+        (None keeps the scraped order), optionally reversed and only with
+        items of this Container. Every combination is sorted once per
+        snapshot and cached as its own listing, so its positions() work for
+        cursor paging too. Returns (listing key, items).
+        """
+        view_key = (key, sort, descending, container)
+        if view_key in self._listings:
+            return view_key, self._listings[view_key]
+
+        if container:
+            _, base = self.sorted_listing(key, sort, descending)
+            return view_key, self.listing(view_key, lambda: [
+                item for item in base if item.get("Container") == container
+            ])
+        if descending:
+            _, base = self.sorted_listing(key, sort)
+            return view_key, self.listing(view_key, lambda: base[::-1])
+
+        items = self.listing(key) if key in LISTINGS else self.of_type(key)
+        if not sort:
+            return key, items
+        if sort != "name":
+            _, items = self.sorted_listing(key, "name")
+        return view_key, self.listing(view_key, lambda: sorted(items, key=SORT_KEYS[sort]))
+
+    def containers(self, key):
+        """The distinct Container values in the listing `key`, for filter options"""
+        return self.listing(("containers", key), lambda: sorted({
+            item["Container"] for item in self.sorted_listing(key, None)[1] if item.get("Container")
+        }))
+
+    def hierarchy(self):
+        """organize_items() of this library, computed once and shared by every request"""
+        if self._hierarchy is None:
+            with self._lock:
+                if self._hierarchy is None:
+                    hierarchy = organize_items(self.of_type("Series", "Season", "Episode"))
+                    self._reverse_index = build_reverse_index(hierarchy[1], hierarchy[2])
+                    self._hierarchy = hierarchy
+        return self._hierarchy
+
+    def reverse_index(self):
+        """(season_index, episode_index) as returned by build_reverse_index()"""
+        self.hierarchy()
+        return self._reverse_index
+
+    def find_season(self, season_id):
+        """(season, show_id), or (None, None) if the season isn't part of a show"""
+        return self.reverse_index()[0].get(season_id, (None, None))
+
+    def find_episode(self, episode_id):
+        """(episode, season_id, show_id), or (None, None, None) if it isn't in any season"""
+        season_index, episode_index = self.reverse_index()
+        if episode_id not in episode_index:
+            return None, None, None
+        episode, season_id = episode_index[episode_id]
+        return episode, season_id, season_index[season_id][1]
+
+
+# =====================
+# Cover art
+# =====================
+
+def primary_tag(item):
+    return (item.get("ImageTags") or {}).get("Primary")
+
+
+def build_covers(library):
+    """
+    Resolves artwork for every item once per snapshot: its own Primary image,
+    else the first child that has one (book in a collection, video in a
+    folder, episode in a season), else for seasons the parent series' cover.
+    """
+    covers = {}
+    for item in library.items:
+        tag = primary_tag(item)
+        if tag:
+            covers[item["Id"]] = (item["Id"], tag)
+
+    for parent_id, children in library.children.items():
+        if parent_id in covers:
+            continue
+        for child in children:
+            tag = primary_tag(child)
+            if tag:
+                covers[parent_id] = (child["Id"], tag)
+                break
+
+    for season in library.of_type("Season"):
+        if season["Id"] not in covers:
+            series_cover = covers.get(season.get("SeriesId") or season.get("ParentId"))
+            if series_cover:
+                covers[season["Id"]] = series_cover
+
+    return covers
+
+
+# =====================
+# Listings
+# =====================
+
+def is_real_media(item):
+    """Filters out phantom / virtual items"""
+    return (
+        item.get("Path")
+        #and item.get("Container")
+        and item.get("LocationType") != "Virtual"
+    )
+
+
+# The lists the library pages page through, by listing() key
+LISTINGS = {
+    "movies": lambda library: [i for i in library.of_type("Movie") if is_real_media(i)],
+    "shows": lambda library: list(library.hierarchy()[0].values()),
+    "Folder": lambda library: library.of_type("Folder"),
+    "MusicAlbum": lambda library: library.of_type("MusicAlbum"),
+}
+
+
+# =====================
+# Sort orders
+# =====================
+
+def _missing_last(value):
+    return (value is None, value if value is not None else 0)
+
+
+def name_key(item):
+    """Case-insensitive, with numbers compared as numbers ("Show 2" before "Show 10")"""
+    name = (item.get("SortName") or item.get("Name") or "").casefold()
+    return [int(part) if i % 2 else part for i, part in enumerate(DIGITS_RE.split(name))]
+
+
+# Sort key functions by the name used in ?sort=. Every other order is sorted
+# from the "name" order, so ties come out by name without recomputing name_key().
+SORT_KEYS = {
+    "name": name_key,
+    "index": lambda item: _missing_last(item.get("IndexNumber")),
+    "container": lambda item: _missing_last(item.get("Container")),
+    "date": lambda item: _missing_last(item.get("DateCreated")),
+}
+
+
+# =====================
+# TV hierarchy
+# =====================
+
+def organize_items(items):
+    """
+    Groups a TV library into shows by Id, seasons per show and episodes per
+    season, both sorted. Episodes without a season go into a pseudo
+    "Season Unknown" of their series. The result is shared between
+    requests, so it's returned as plain dicts that callers only read.
+    """
+    shows = {}
+    seasons = []
+    episodes = []
+    seasons_by_show = defaultdict(list)
+    episodes_by_season = defaultdict(list)
+
+    for item in items:
+        item_type = item.get("Type")
+        if item_type == "Series":
+            shows[item["Id"]] = item
+        elif item_type == "Season":
+            seasons.append(item)
+        elif item_type == "Episode":
+            episodes.append(item)
+
+    for item in seasons:
+        parent_id = item.get("ParentId")
+        if parent_id and parent_id in shows:
+            seasons_by_show[parent_id].append(item)
+
+    pseudo_seasons = set()
+    for item in episodes:
+        season_id = item.get("ParentId") or item.get("SeasonId")
+
+        if not season_id:
+            series_id = item.get("SeriesId")
+            if not series_id:
+                continue
+            season_id = f"unknown_season_{series_id}"
+            if season_id not in pseudo_seasons:
+                pseudo_seasons.add(season_id)
+                seasons_by_show[series_id].append(Item({
+                    "Id": season_id,
+                    "Name": "Season Unknown",
+                    "IndexNumber": 0,
+                    "ParentId": series_id,
+                    "ImageUrl": None
+                }.items()))
+
+        episodes_by_season[season_id].append(item)
+
+    for show_seasons in seasons_by_show.values():
+        show_seasons.sort(key=lambda s: s.get("IndexNumber") or 0)
+
+    for eps in episodes_by_season.values():
+        eps.sort(key=lambda e: (e.get("ParentIndexNumber") or 0, e.get("IndexNumber") or 0))
+
+    return shows, dict(seasons_by_show), dict(episodes_by_season)
+
+
+def build_reverse_index(seasons_by_show, episodes_by_season):
+    """
+    Maps back up the tree: season Id -> (season, show Id) and
+    episode Id -> (episode, season Id). Only seasons that belong to a show
+    and episodes inside those seasons are indexed.
+    """
+    season_index = {}
+    episode_index = {}
+    for show_id, seasons in seasons_by_show.items():
+        for season in seasons:
+            season_index[season["Id"]] = (season, show_id)
+            for ep in episodes_by_season.get(season["Id"], []):
+                episode_index[ep["Id"]] = (ep, season["Id"])
+    return season_index, episode_index
+
+
+# =====================
+# Snapshots
+# =====================
+
+class Snapshot:
+    """
+    One version of the catalogue. Only `info` (library name -> LibraryId,
+    CollectionType, Count) is read up front; each library is parsed and
+    indexed the first time it's asked for, and the search index (which needs
+    every library) the first time anyone searches. Never changes once loaded.
+    """
+
+    def __init__(self, info, load_library, version, modified=None):
+        self.version = version
+        self.modified = modified if modified is not None else time.time()  # for Last-Modified
+        self.info = info
+        self._load_library = load_library
+        self._libraries = {}
+        self._library_locks = {name: threading.Lock() for name in info}
+        self._search = None
+        self._lock = threading.Lock()
+
+    def library(self, name):
+        """The Library called `name`, loaded now if this is its first use, or None"""
+        library = self._libraries.get(name)
+        if library is None and name in self.info:
+            with self._library_locks[name]:
+                library = self._libraries.get(name)
+                if library is None:
+                    library = Library(name, self._load_library(name))
+                    # Warm the expensive derived views along with the items
+                    library.covers()
+                    if library.collection_type == "tvshows":
+                        library.hierarchy()
+                    self._libraries[name] = library
+        return library
+
+    def release(self, name):
+        """Drops a loaded library, for one-pass readers; it's loaded again if used"""
+        with self._library_locks[name]:
+            self._libraries.pop(name, None)
+
+    @property
+    def libraries(self):
+        """Every library by name, loading the ones nobody has used yet"""
+        return {name: self.library(name) for name in self.info}
+
+    def warm(self, previous):
+        """Loads what `previous`, the snapshot this one replaces, had in use"""
+        for name in list(previous._libraries):
+            if name in self.info:
+                self.library(name)
+        if previous._search is not None:
+            self.search
+
+    @property
+    def search(self):
+        """SearchIndex over every library (so the first search loads them all)"""
+        if self._search is None:
+            with self._lock:
+                if self._search is None:
+                    self._search = SearchIndex(self.libraries)
+        return self._search
+
+
+def library_info(library_id, collection_type, count):
+    return {"LibraryId": library_id, "CollectionType": collection_type, "Count": count}
+
+
+def file_version(path):
+    """Changes whenever the file is replaced or rewritten, None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def load_snapshot(path, version=None, search=True):
+    """
+    Snapshot of a whole all_items.json, parsed and indexed right away. With
+    search=False the search index is left to be built on first use, for
+    callers that never search.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        modified = os.fstat(f.fileno()).st_mtime
+        libraries = json.load(f, object_hook=item_hook({}))
+
+    info = {
+        name: library_info(data.get("LibraryId"), data.get("CollectionType"), len(data.get("Items", [])))
+        for name, data in libraries.items()
+    }
+    snapshot = Snapshot(info, libraries.__getitem__, version or file_version(path), modified)
+    snapshot.libraries
+    if search:
+        snapshot.search
+    return snapshot
+
+
+def open_library(path):
+    """Opens one of api.py's per-library JSON Lines files, None (shown as empty) if it's gone"""
+    try:
+        return open(path, "r", encoding="utf-8")
+    except FileNotFoundError:
+        print(f"Library file missing, showing it as empty: {path}")
+        return None
+
+
+def read_library(f):
+    """The Items of an opened per-library file, read from the start (so a failed read can be retried)"""
+    if f is None:
+        return []
+    strings = {}
+    f.seek(0)
+    return [Item(json.loads(line).items(), strings) for line in f if line.strip()]
+
+
+def open_snapshot(manifest_path, version=None):
+    """
+    Lazy Snapshot of api.py's scrape directory: only the manifest is read
+    here, each library's .jsonl file when the library is first used.
+
+    Every library file is opened right away though, so a later scrape
+    renaming or deleting them can't change what this snapshot serves.
+    """
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        modified = os.fstat(f.fileno()).st_mtime
+        manifest = json.load(f)
+
+    directory = os.path.dirname(manifest_path)
+    info = {
+        lib.get("Name", "Unknown"): library_info(library_id, lib.get("CollectionType"), lib.get("Count", 0))
+        for library_id, lib in manifest.items()
+    }
+
+    files = {
+        name: open_library(os.path.join(directory, f"{lib['LibraryId']}.jsonl"))
+        for name, lib in info.items()
+    }
+
+    def load_library(name):
+        library = dict(info[name])
+        library["Items"] = read_library(files[name])
+        return library
+
+    return Snapshot(info, load_library, version or file_version(manifest_path), modified)
+
+
+class Catalogue:
+    """
+    Holds the current Snapshot. A background thread polls the snapshot file
+    and, when its version changes, opens the new one off the request path
+    before swapping it in with a single assignment. A request reads
+    `snapshot` (or calls get()) once and keeps that version even if a newer
+    one lands while it runs.
+
+    With a snapshot database (snapshot_db.py) every worker process serves
+    from that shared file. Otherwise, with a scrape manifest the snapshot is
+    opened lazily (open_snapshot()): startup only reads the manifest, and a
+    reload loads just the libraries (and search index) the current snapshot
+    has in use. Without either the whole all_items.json at `path` is loaded
+    (load_snapshot()).
+    """
+
+    def __init__(self, path, manifest_path=None, database_path=None, interval=RELOAD_INTERVAL):
+        self.path = path
+        self.manifest_path = manifest_path
+        self.database_path = database_path
+        self.interval = interval
+        self.snapshot = None
+        self._seen_version = None
+
+    def source(self):
+        """(file to watch, function that opens it)"""
+        if self.database_path and os.path.exists(self.database_path):
+            from snapshot_db import open_database
+            return self.database_path, open_database
+        if self.manifest_path and os.path.exists(self.manifest_path):
+            return self.manifest_path, open_snapshot
+        return self.path, load_snapshot
+
+    def start(self):
+        threading.Thread(target=self._watch, daemon=True).start()
+        return self
+
+    def get(self, library_name):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        return snapshot.library(library_name)
+
+    def reload(self):
+        """Loads the file if it changed since the last attempt, returns True if a new snapshot is live"""
+        path, open_file = self.source()
+        version = file_version(path)
+        if version is None or version == self._seen_version:
+            return False
+        # Remember failed versions too, so a broken file isn't re-parsed every tick
+        self._seen_version = version
+
+        started = time.monotonic()
+        try:
+            snapshot = open_file(path, version)
+            # Load what's in use before the swap: requests don't wait on it, and
+            # a library that fails to parse keeps the current snapshot live
+            if isinstance(snapshot, Snapshot) and isinstance(self.snapshot, Snapshot):
+                snapshot.warm(self.snapshot)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"Could not load {path}, keeping the current snapshot:", e)
+            return False
+
+        self.snapshot = snapshot
+        print(f"Loaded {path}: {len(snapshot.info)} libraries in {time.monotonic() - started:.1f}s")
+        return True
+
+    def _watch(self):
+        while True:
+            try:
+                self.reload()
+            except Exception as e:
+                print("Catalogue reload failed:", e)
+            time.sleep(self.interval)
@@ -1,6 +1,16 @@
+import itertools
+import json
 import os
+import queue
+import re
 import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
 import requests
+from requests.adapters import HTTPAdapter
 
 with open("data.txt", "r") as file:
     BASE_URL = file.readline().strip()
@@ -13,119 +23,552 @@ HEADERS = {
 }
 
 DOWNLOAD_ROOT = "downloads"
+DOWNLOAD_WORKERS = 6  # files downloading at once, however much is queued
+JOB_FAN_OUT = 3  # files of one show/season downloading at once, so it can't take every worker
+DOWNLOAD_ATTEMPTS = 3  # each one resumes from what the last one got
+MAX_CONNECTIONS = 12  # connections fetching file bytes at once, every segment of every worker included
 
+# Big files are fetched as several byte ranges at once, one connection each,
+# when the server takes Range requests. MAX_SEGMENTS = 1 turns this off.
+# They share MAX_CONNECTIONS with everything else being downloaded.
+MAX_SEGMENTS = 8
+SEGMENT_BYTES = 256 * 1024 * 1024  # one more connection per this much file, up to MAX_SEGMENTS
+SEGMENTED_MIN_BYTES = 2 * SEGMENT_BYTES
+SAVE_PROGRESS_BYTES = 64 * 1024 * 1024  # how much a crash can cost a segmented download
 
-# =========================
-# Public API (called by Flask)
-# =========================
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+|\*)-?(\d*)/(\d+)")
 
-def download_show_background(show_id, shows, seasons_by_show, episodes_by_season):
-    threading.Thread(
-        target=_download_show_worker,
-        args=(show_id, shows, seasons_by_show, episodes_by_season),
-        daemon=True
-    ).start()
+RATE_WINDOW = 5  # seconds the current rate of a download is measured over
+STALL_SECONDS = 30  # a download with no bytes for this long is shown as stalled
+KEEP_FINISHED = 200  # finished and failed files still listed on the /downloads page
 
+# Lower goes first: an episode someone clicked shouldn't wait behind a whole show
+PRIORITY_EPISODE = 0
+PRIORITY_SEASON = 1
+PRIORITY_SHOW = 2
 
-def download_season_background(season_id, shows, seasons_by_show, episodes_by_season):
-    threading.Thread(
-        target=_download_season_worker,
-        args=(season_id, shows, seasons_by_show, episodes_by_season),
-        daemon=True
-    ).start()
+# One pool of keep-alive connections for every worker
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
 
+# Held for as long as a response with file bytes is open
+CONNECTIONS = threading.BoundedSemaphore(MAX_CONNECTIONS)
 
-def download_episode_background(episode):
-    threading.Thread(
-        target=_download_episode_worker,
-        args=(episode, None),
-        daemon=True
-    ).start()
 
+# =========================
+# Progress
+# =========================
+
+class ProgressRegistry:
+    """
+    What every queued, running and recently finished file is doing, for the
+    /downloads page. The scheduler and workers report into it; readers get
+    plain dicts from snapshot(), and wait() blocks until something changes
+    so a live view doesn't have to poll.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._files = OrderedDict()  # item Id -> state of the file, in queueing order
+        self._samples = {}  # item Id -> deque of (time, bytes done) over the last RATE_WINDOW
+        self._changed = threading.Condition()
+
+    def queued(self, item_id, name, job, job_name):
+        with self._changed:
+            now = time.time()
+            self._files.pop(item_id, None)
+            self._files[item_id] = {
+                "id": item_id, "name": name, "job": job, "job_name": job_name,
+                "state": "queued", "done": 0, "total": None, "error": None,
+                "queued": now, "started": None, "updated": now,
+            }
+            self._samples.pop(item_id, None)
+
+            finished = [key for key, file in self._files.items() if file["state"] not in ("queued", "downloading")]
+            for key in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+                del self._files[key]
+            self._notify()
+
+    def started(self, item_id, done, total):
+        with self._changed:
+            file = self._files.get(item_id)
+            if file:
+                now = time.time()
+                file.update(state="downloading", done=done, total=total, error=None, updated=now)
+                file["started"] = file["started"] or now
+                self._samples[item_id] = deque([(now, done)])
+                self._notify()
+
+    def advance(self, item_id, size):
+        with self._changed:
+            file = self._files.get(item_id)
+            if file:
+                now = time.time()
+                file["done"] += size
+                file["updated"] = now
+                samples = self._samples.setdefault(item_id, deque())
+                samples.append((now, file["done"]))
+                # Keep one sample from before the window as the baseline
+                while len(samples) > 2 and samples[1][0] <= now - RATE_WINDOW:
+                    samples.popleft()
+                self._notify()
+
+    def finished(self, item_id, state="finished", error=None):
+        with self._changed:
+            file = self._files.get(item_id)
+            if file:
+                file.update(state=state, error=error, updated=time.time())
+                self._samples.pop(item_id, None)
+                self._notify()
+
+    def wait(self, version, timeout):
+        """Blocks until the version differs from `version` or `timeout` passes, returns the version"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def snapshot(self):
+        """Every listed file with its rate and ETA, the same summed up per job, and overall totals"""
+        with self._changed:
+            now = time.time()
+            files = []
+            for item_id, file in self._files.items():
+                file = dict(file)
+                samples = self._samples.get(item_id)
+                rate = 0
+                if file["state"] == "downloading" and samples and now > samples[0][0]:
+                    rate = (file["done"] - samples[0][1]) / (now - samples[0][0])
+                remaining = (file["total"] or 0) - file["done"]
+                file["rate"] = rate
+                file["eta"] = remaining / rate if rate and remaining > 0 else None
+                file["stalled"] = file["state"] == "downloading" and now - file["updated"] > STALL_SECONDS
+                files.append(file)
+            version = self.version
+
+        jobs = OrderedDict()
+        for file in files:
+            job = jobs.setdefault(file["job"], {
+                "job": file["job"], "name": file["job_name"], "files": 0, "finished": 0,
+                "failed": 0, "running": 0, "stalled": 0, "done": 0, "total": 0, "rate": 0,
+            })
+            job["files"] += 1
+            job["finished"] += file["state"] in ("finished", "skipped")
+            job["failed"] += file["state"] == "failed"
+            job["running"] += file["state"] == "downloading"
+            job["stalled"] += file["stalled"]
+            job["done"] += file["done"]
+            job["total"] += file["total"] or 0
+            job["rate"] += file["rate"]
+
+        for job in jobs.values():
+            if job["running"]:
+                job["state"] = "downloading"
+            elif job["finished"] + job["failed"] < job["files"]:
+                job["state"] = "queued"
+            else:
+                job["state"] = "failed" if job["failed"] else "finished"
+            remaining = job["total"] - job["done"]
+            job["eta"] = remaining / job["rate"] if job["rate"] and remaining > 0 else None
+
+        return {
+            "version": version,
+            "time": now,
+            "rate": sum(file["rate"] for file in files),
+            "running": sum(file["state"] == "downloading" for file in files),
+            "queued": sum(file["state"] == "queued" for file in files),
+            "jobs": list(jobs.values()),
+            "files": files,
+        }
+
+    def _notify(self):
+        self.version += 1
+        self._changed.notify_all()
+
+
+PROGRESS = ProgressRegistry()
 
 
 # =========================
-# Workers
+# Scheduler
+# =========================
+
+class DownloadScheduler:
+    """
+    One queue for every download. A fixed pool of worker threads takes files
+    off a priority queue (lowest priority first, then in the order they were
+    queued), so at most `workers` files download at once. An item that's
+    already queued isn't queued twice: queueing it again with a better
+    priority moves it up, and it goes to the show/season folder either
+    request gave it rather than the plain downloads folder. An item that's
+    downloading isn't queued again unless it's for a different folder.
+
+    Each file belongs to a job (the show, season or episode that was asked
+    for) and at most `fan_out` files of one job download at once. A worker
+    that takes a file whose job is at its limit puts it aside until one of
+    the job's files finishes, and moves on to the next job in the queue.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, fan_out=JOB_FAN_OUT):
+        self.workers = workers
+        self.fan_out = fan_out
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._pending = {}  # item Id -> its live queue entry
+        self._running = {}  # item Id -> folder it's downloading to
+        self._job_running = defaultdict(int)  # job -> files downloading
+        self._held = defaultdict(deque)  # job -> entries waiting for a free slot
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, ep, target_dir, priority, job=None, job_name=None):
+        """Queues one file, returns False if it's already queued (as urgently) or downloading"""
+        item_id = ep["Id"]
+        name = _file_name(ep)
+        job, job_name = job or item_id, job_name or name
+        with self._lock:
+            if item_id in self._running and target_dir in (None, self._running[item_id]):
+                return False
+            queued = self._pending.get(item_id)
+            if queued is not None:
+                queued_priority, _, _, queued_job, queued_job_name, _, queued_dir = queued
+                if queued_dir is not None:
+                    # Keep the folder it was queued for, and its job with it
+                    target_dir, job, job_name = queued_dir, queued_job, queued_job_name
+                priority = min(priority, queued_priority)
+                if (priority, target_dir) == (queued_priority, queued_dir):
+                    return False
+            # An entry it replaces stays in the queue and is skipped when it comes out
+            entry = (priority, next(self._order), item_id, job, job_name, ep, target_dir)
+            self._pending[item_id] = entry
+            self._queue.put(entry)
+            PROGRESS.queued(item_id, name, job, job_name)
+
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return True
+
+    def join(self):
+        """Blocks until everything queued so far has been downloaded"""
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            entry = self._queue.get()
+            _, _, item_id, job, _, ep, target_dir = entry
+            try:
+                with self._lock:
+                    if self._pending.get(item_id) is not entry:
+                        # Replaced by a more urgent entry
+                        self._release(job)
+                        continue
+                    if self._job_running[job] >= self.fan_out:
+                        self._held[job].append(entry)
+                        continue
+                    del self._pending[item_id]
+                    self._running[item_id] = target_dir
+                    self._job_running[job] += 1
+                try:
+                    _download_episode_worker(ep, target_dir)
+                except Exception as e:
+                    print("Download failed:", item_id, e)
+                    PROGRESS.finished(item_id, "failed", str(e))
+                finally:
+                    with self._lock:
+                        if self._running.get(item_id) == target_dir:
+                            del self._running[item_id]
+                        self._job_running[job] -= 1
+                        if not self._job_running[job]:
+                            del self._job_running[job]
+                        self._release(job)
+            finally:
+                # After any release, so join() never sees a held file as done
+                self._queue.task_done()
+
+    def _release(self, job):
+        """Requeues the job's next held file if it has a free slot (call with the lock held)"""
+        held = self._held.get(job)
+        while held and self._job_running.get(job, 0) < self.fan_out:
+            entry = held.popleft()
+            if self._pending.get(entry[2]) is entry:
+                self._queue.put(entry)
+                break
+        if job in self._held and not held:
+            del self._held[job]
+
+
+SCHEDULER = DownloadScheduler()
+
+
+# =========================
+# Public API (called by Flask)
 # =========================
 
-def _download_show_worker(show_id, shows, seasons_by_show, episodes_by_season):
+def download_show_background(show_id, shows, seasons_by_show, episodes_by_season):
     show = shows.get(show_id)
     if not show:
         print("Show not found:", show_id)
         return
 
     show_name = safe(show["Name"])
-    print(f"Starting show download: {show_name}")
+    print(f"Queueing show download: {show_name}")
 
     for season in seasons_by_show.get(show_id, []):
-        _download_season(season, show_name, episodes_by_season)
-    
-
-def _download_season_worker(season_id, shows, seasons_by_show, episodes_by_season):
-    for show_id, seasons in seasons_by_show.items():
-        for season in seasons:
-            if season["Id"] == season_id:
-                show_name = safe(shows[show_id]["Name"])
-                _download_season(season, show_name, episodes_by_season)
-                return
+        _queue_season(season, show_name, episodes_by_season, PRIORITY_SHOW, show_id, show_name)
+
 
-    print("Season not found:", season_id)
+def download_season_background(season_id, shows, season_index, episodes_by_season):
+    # season_index: season Id -> (season, show Id), see catalogue.build_reverse_index
+    season, show_id = season_index.get(season_id, (None, None))
+    if not season:
+        print("Season not found:", season_id)
+        return
 
+    show_name = safe(shows[show_id]["Name"])
+    _queue_season(season, show_name, episodes_by_season, PRIORITY_SEASON, season_id)
 
-def _download_season(season, show_name, episodes_by_season):
+
+def download_episode_background(episode):
+    SCHEDULER.submit(episode, None, PRIORITY_EPISODE)
+
+
+def _queue_season(season, show_name, episodes_by_season, priority, job, job_name=None):
     season_name = safe(season.get("Name", f"Season {season.get('IndexNumber', '')}"))
     season_dir = os.path.join(DOWNLOAD_ROOT, show_name, season_name)
-    os.makedirs(season_dir, exist_ok=True)
 
     episodes = episodes_by_season.get(season["Id"], [])
-    print(f"Downloading {len(episodes)} episodes for {season_name}")
+    print(f"Queueing {len(episodes)} episodes for {season_name}")
 
     for ep in episodes:
-        _download_episode_worker(ep, season_dir)
+        SCHEDULER.submit(ep, season_dir, priority, job, job_name or f"{show_name} – {season_name}")
 
 
+# =========================
+# Workers
+# =========================
+
 def _download_episode_worker(ep, season_dir):
     item_id = ep["Id"]
-    container_raw = ep.get("Container", "mkv")
-    container = container_raw.split(",")[0].strip()  # Fix extension by picking the first
-
-    ep_num = ep.get("IndexNumber")
-    season_num = ep.get("ParentIndexNumber")
-
-    filename = safe(ep.get("Name", item_id))
-    if season_num and ep_num:
-        filename = f"S{season_num:02d}E{ep_num:02d} - {filename}"
-
-    filename = f"{filename}.{container}"
+    filename = _file_name(ep)
 
     if season_dir is None:
         season_dir = DOWNLOAD_ROOT
+    os.makedirs(season_dir, exist_ok=True)
 
     path = os.path.join(season_dir, filename)
 
     if os.path.exists(path):
         print("Already exists, skipping:", filename)
+        PROGRESS.finished(item_id, "skipped")
         return
 
     url = f"{BASE_URL}/Items/{item_id}/Download"
-    print("Downloading:", filename)
+    part = path + ".part"
+    print("Resuming:" if os.path.exists(part) else "Downloading:", filename)
+
+    error = None
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            if _fetch(url, part, item_id):
+                os.replace(part, path)
+                print("Finished:", filename)
+                PROGRESS.finished(item_id)
+                return
+            error = "Incomplete"
+            print("Incomplete, resuming:", filename)
+        except (requests.RequestException, OSError) as e:
+            error = str(e)
+            print(f"Download failed ({attempt}/{DOWNLOAD_ATTEMPTS}):", filename, e)
+
+    print("Giving up for now, the next download resumes from:", part)
+    PROGRESS.finished(item_id, "failed", error)
+
+
+def _fetch(url, part, item_id):
+    """Fetches the rest of the file into `part`, segmented if it can be; True once complete"""
+    progress = part + ".segments"
+    if os.path.exists(progress):
+        plan = _load_segments(part, progress)
+        if plan:
+            return _fetch_segments(url, part, progress, *plan, item_id)
+    return _fetch_part(url, part, progress, item_id)
+
+
+def _fetch_part(url, part, progress, item_id):
+    """
+    Appends the rest of the file to `part`, asking only for the bytes past
+    what's already there. Returns True once it holds exactly as many bytes
+    as the server says the file has. A whole big file from a server that
+    takes ranges is handed to _fetch_segments instead.
+    """
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"Accept-Encoding": "identity"}  # sizes must be of the file, not a compressed stream
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    plan = None
+    with CONNECTIONS, SESSION.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:
+            # Nothing past `offset`: done, unless the file on the server got smaller
+            match = CONTENT_RANGE_RE.fullmatch(r.headers.get("Content-Range", ""))
+            if match and int(match.group(3)) == offset:
+                PROGRESS.started(item_id, offset, offset)
+                return True
+            os.remove(part)
+            return False
+        r.raise_for_status()
+
+        match = CONTENT_RANGE_RE.fullmatch(r.headers.get("Content-Range", ""))
+        if r.status_code == 206 and match and int(match.group(1)) == offset:
+            total = int(match.group(3))
+            mode = "ab"
+        else:
+            # Server sent the whole file (it ignored the Range, or there was none)
+            length = r.headers.get("Content-Length")
+            total = int(length) if length else None
+            mode = "wb"
+            if total and r.headers.get("Accept-Ranges") == "bytes":
+                plan = _plan_segments(part, progress, total)
+
+        if plan is None:
+            PROGRESS.started(item_id, offset if mode == "ab" else 0, total)
+            with open(part, mode) as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        f.write(chunk)
+                        PROGRESS.advance(item_id, len(chunk))
+
+    if plan:
+        # This response goes unread, its connection back to CONNECTIONS for the segments
+        return _fetch_segments(url, part, progress, *plan, item_id)
+
+    size = os.path.getsize(part)
+    if total is None:
+        return True  # nothing to check it against
+    if size > total:
+        os.remove(part)
+    return size == total
+
+# =========================
+# Segmented downloads
+# =========================
 
+def _plan_segments(part, progress, size):
+    """
+    Splits a file of `size` bytes into byte ranges and preallocates `part`
+    for them, or returns None if it's too small to be worth segmenting.
+    """
+    count = min(MAX_SEGMENTS, ceil(size / SEGMENT_BYTES))
+    if size < SEGMENTED_MIN_BYTES or count < 2:
+        return None
+
+    step = ceil(size / count)
+    segments = [[start, min(start + step, size), 0] for start in range(0, size, step)]
+    # Plan first: a preallocated part without one would pass for a finished file
+    _save_segments(progress, size, segments)
+    with open(part, "wb") as f:
+        f.truncate(size)
+    return size, segments
+
+
+def _load_segments(part, progress):
+    """The plan of an interrupted segmented download, None (starting over) if it doesn't fit `part`"""
     try:
-        with requests.get(url, headers=HEADERS, stream=True, timeout=60) as r:
+        with open(progress, "r") as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        plan = None
+
+    if plan and os.path.exists(part) and os.path.getsize(part) == plan["size"]:
+        return plan["size"], plan["segments"]
+
+    for path in (part, progress):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return None
+
+
+def _save_segments(progress, size, segments):
+    tmp = progress + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"size": size, "segments": segments}, f)
+    os.replace(tmp, progress)
+
+
+def _fetch_segments(url, part, progress, size, segments, item_id):
+    """
+    Fetches every unfinished segment [start, end, bytes done] on its own
+    connection, as CONNECTIONS has them free, writing at its offset in
+    `part`. Progress is saved as it goes so a later attempt picks up each
+    segment where it stopped.
+    """
+    lock = threading.Lock()
+    unsaved = [0]
+    PROGRESS.started(item_id, sum(done for _, _, done in segments), size)
+
+    def fetch(segment):
+        start, end, done = segment
+        if start + done >= end:
+            return
+        headers = {"Accept-Encoding": "identity", "Range": f"bytes={start + done}-{end - 1}"}
+        with CONNECTIONS, SESSION.get(url, headers=headers, stream=True, timeout=60) as r:
             r.raise_for_status()
-            with open(path, "wb") as f:
+            if r.status_code != 206:
+                raise requests.RequestException(f"Expected part of the file, got HTTP {r.status_code}")
+
+            # Unbuffered, so saved progress never counts bytes still in a buffer
+            with open(part, "r+b", buffering=0) as f:
+                f.seek(start + done)
                 for chunk in r.iter_content(chunk_size=1024 * 1024):
-                    if chunk:
-                        f.write(chunk)
+                    chunk = chunk[:end - start - segment[2]]
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+                        unsaved[0] += len(chunk)
+                        if unsaved[0] >= SAVE_PROGRESS_BYTES:
+                            _save_segments(progress, size, segments)
+                            unsaved[0] = 0
+                    PROGRESS.advance(item_id, len(chunk))
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            for _ in pool.map(fetch, segments):
+                pass
+    finally:
+        with lock:
+            _save_segments(progress, size, segments)
 
-        print("Finished:", filename)
+    if all(start + done >= end for start, end, done in segments):
+        os.remove(progress)
+        return True
+    return False
 
-    except Exception as e:
-        print("Download failed:", filename, e)
 
 # =========================
 # Helpers
 # =========================
 
+def _file_name(ep):
+    item_id = ep["Id"]
+    container_raw = ep.get("Container", "mkv")
+    container = container_raw.split(",")[0].strip()  # Fix extension by picking the first
+
+    ep_num = ep.get("IndexNumber")
+    season_num = ep.get("ParentIndexNumber")
+
+    filename = safe(ep.get("Name", item_id))
+    if season_num and ep_num:
+        filename = f"S{season_num:02d}E{ep_num:02d} - {filename}"
+
+    return f"{filename}.{container}"
+
+
 def safe(name: str) -> str:
     return "".join(c for c in name if c not in r'\/:*?"<>|').strip()
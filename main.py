@@ -1,17 +1,33 @@
-from flask import Flask, render_template, abort, url_for, request
-import json
+from flask import Flask, render_template, stream_template, abort, url_for, request, jsonify, send_file
+from functools import wraps
+from hashlib import sha1
 from math import ceil
-from collections import defaultdict
+import json
+import time
+import requests
+from api import DATA_FILE, MANIFEST_FILE
+from catalogue import Catalogue, SORT_KEYS
+from response_cache import ResponseCache
+from snapshot_db import DATABASE_FILE  # shared snapshot for multi-process serving
+from thumbnails import ThumbnailCache, image_mimetype
 from download import (
     download_show_background,
     download_season_background,
-    download_episode_background
+    download_episode_background,
+    PROGRESS
 )
 
 app = Flask(__name__)
 
-DATA_FILE = "all_items.json"
 ITEMS_PER_PAGE = 100
+SEARCH_LIMIT = 50
+MAX_PER_PAGE = 1000
+STREAM_THRESHOLD = 250  # pages with more items than this are streamed
+IMAGE_MAX_AGE = 365 * 24 * 3600  # tagged images never change, a new tag is a new URL
+UNTAGGED_IMAGE_MAX_AGE = 3600
+PROGRESS_EVENT_INTERVAL = 1  # seconds between /downloads/events updates, however busy the downloads
+PROGRESS_EVENT_TIMEOUT = 10  # an update at least this often, so rates decay while nothing moves
+PROGRESS_EVENT_LIFETIME = 300  # seconds before a stream ends and the browser reconnects, freeing its thread
 
 with open("data.txt", "r") as file:
     BASE_URL = file.readline().strip()
@@ -22,74 +38,253 @@ with open("data.txt", "r") as file:
 # Load libraries
 # =====================
 
-with open(DATA_FILE, "r", encoding="utf-8") as f:
-    LIBRARIES = json.load(f)
+# Loaded and kept up to date in the background, see catalogue.Catalogue
+CATALOGUE = Catalogue(DATA_FILE, MANIFEST_FILE, DATABASE_FILE).start()
+
+
+@app.before_request
+def require_snapshot():
+    if CATALOGUE.snapshot is None and request.endpoint != "static":
+        return "Loading library snapshot, try again in a moment.", 503, {"Retry-After": "2"}
 
 
 # =====================
 # Helpers
 # =====================
 
-def is_real_media(item):
-    """Filters out phantom / virtual items"""
-    return (
-        item.get("Path")
-        #and item.get("Container")
-        and item.get("LocationType") != "Virtual"
-    )
+def primary_image_url(item):
+    return image_url(item["Id"], item.get("ImageTags", {}).get("Primary"))
+
+
+def image_url(item_id, image_tag):
+    """The item's Primary image through our thumbnail cache, see thumbnail()"""
+    return url_for("thumbnail", item_id=item_id, tag=image_tag)
+
+
+def tagged_image_url(item):
+    image_tag = item.get("ImageTags", {}).get("Primary")
+    if not image_tag:
+        return None
+    return image_url(item["Id"], image_tag)
+
+
+def cover_image_url(library):
+    """ImageUrl function for decorate() using the library's precomputed covers"""
+    def cover_url(item):
+        cover = library.cover(item)
+        return image_url(*cover) if cover else None
+    return cover_url
+
+
+def item_url(library, item):
+    """The page that shows this item (for items without a page of their own, where they're listed)"""
+    item_type = item.get("Type")
+    parent_id = item.get("ParentId")
+
+    if item_type == "Series":
+        return url_for("show", library_name=library.name, show_id=item["Id"])
+    if item_type == "Season":
+        return url_for("season", library_name=library.name, season_id=item["Id"])
+    if item_type == "Episode":
+        _, season_id, _ = library.find_episode(item["Id"])
+        if season_id:
+            return url_for("season", library_name=library.name, season_id=season_id)
+    if item_type == "MusicAlbum":
+        return url_for("album", library_name=library.name, album_id=item["Id"])
+    if item_type == "Audio" and (item.get("AlbumId") or parent_id):
+        return url_for("album", library_name=library.name, album_id=item.get("AlbumId") or parent_id)
+    if item_type == "Folder" and library.collection_type == "books":
+        return url_for("book_collection", library_name=library.name, collection_id=item["Id"])
+    if item_type == "Book" and parent_id:
+        return url_for("book_collection", library_name=library.name, collection_id=parent_id)
+    if item_type == "Folder" and library.collection_type == "musicvideos":
+        return url_for("music_video_folder", library_name=library.name, folder_id=item["Id"])
+    if item_type in ("MusicVideo", "Video") and parent_id:
+        return url_for("music_video_folder", library_name=library.name, folder_id=parent_id)
+    return url_for("library", library_name=library.name)
 
 
-def organize_items(items):
-    shows = {}
-    seasons_by_show = defaultdict(list)
-    episodes_by_season = defaultdict(list)
+# =====================
+# Listings
+# =====================
 
-    for item in items:
-        if item.get("Type") == "Series":
-            shows[item["Id"]] = item
+def paginate(items, positions=None):
+    """
+    Slices the requested page out of `items` without touching the rest.
+    Pages are picked with ?page=N (and ?per_page=N), or with ?after=<item Id>
+    for cursor paging that stays put when items are added in front.
+    `positions` (Id -> index) makes the cursor lookup O(1).
+    Returns the page and a pager dict for the templates.
+    """
+    per_page = min(max(request.args.get("per_page", ITEMS_PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    after = request.args.get("after")
+
+    if after:
+        if positions is not None:
+            index = positions.get(after)
+        else:
+            index = next((i for i, item in enumerate(items) if item["Id"] == after), None)
+        if index is None:
+            abort(404)
+        start = index + 1
+        page = None  # a cursor page needn't line up with the numbered pages
+    else:
+        page = max(request.args.get("page", 1, type=int), 1)
+        start = (page - 1) * per_page
 
-    for item in items:
-            if item.get("Type") == "Series":
-                shows[item["Id"]] = item
+    end = start + per_page
+    page_items = items[start:end]
+
+    # Keep any other query arguments (sorting, per_page, ...) on the links
+    args = {k: v for k, v in request.args.items() if k not in ("page", "after")}
+    args.update(request.view_args)
+
+    prev_url = next_url = None
+    if start > 0 and after:
+        # The per_page items before this page, by cursor too
+        prev_start = max(start - per_page, 0)
+        if prev_start:
+            prev_url = url_for(request.endpoint, **args, after=items[prev_start - 1]["Id"])
+        else:
+            prev_url = url_for(request.endpoint, **args)
+    elif start > 0:
+        prev_url = url_for(request.endpoint, **args, page=max(page - 1, 1))
+    if end < len(items):
+        if after:
+            next_url = url_for(request.endpoint, **args, after=page_items[-1]["Id"])
+        else:
+            next_url = url_for(request.endpoint, **args, page=page + 1)
+
+    pager = {
+        "page": page,
+        "per_page": per_page,
+        "total_pages": ceil(len(items) / per_page),
+        "first": start + 1,
+        "last": start + len(page_items),
+        "total": len(items),
+        "prev_url": prev_url,
+        "next_url": next_url
+    }
+    return page_items, pager
+
+
+def sorted_view(library, key):
+    """
+    The listing `key` as asked for by ?sort= (a catalogue.SORT_KEYS name),
+    ?order=desc and ?container=. Without ?sort= items keep the scraped order.
+    Returns (items, positions) ready for paginate(), and the sort options
+    for the templates. Positions are only built (and cached) for views that
+    are paged with an ?after= cursor, else they're None.
+    """
+    sort = request.args.get("sort", "")
+    descending = request.args.get("order") == "desc"
+    container = request.args.get("container", "")
+    if sort and sort not in SORT_KEYS:
+        abort(400)
+
+    options = {
+        "sorts": list(SORT_KEYS),
+        "containers": library.containers(key),
+        "sort": sort,
+        "order": "desc" if descending else "asc",
+        "container": container
+    }
 
-    for item in items:
-        if item.get("Type") == "Season":
-            #if item.get("IndexNumber", 0) == 0:
-            #    continue
-            parent_id = item.get("ParentId")
-            if parent_id and parent_id in shows:
-                seasons_by_show[parent_id].append(item)
+    if container and container not in options["containers"]:
+        return [], None, options
 
+    view_key, items = library.sorted_listing(key, sort or None, descending, container or None)
+    positions = library.positions(view_key) if request.args.get("after") else None
+    return items, positions, options
+
+
+def decorate(items, make_image_url):
+    """Copies of the items (only ever one page) with their ImageUrl set, made as they're rendered"""
     for item in items:
-        if item.get("Type") == "Episode":
-            season_id = item.get("ParentId") or item.get("SeasonId")
-
-            if not season_id:
-                series_id = item.get("SeriesId")
-                if series_id:
-                    pseudo_season_id = f"unknown_season_{series_id}"
-                    if not any(s["Id"] == pseudo_season_id for s in seasons_by_show[series_id]):
-                        pseudo_season = {
-                            "Id": pseudo_season_id,
-                            "Name": "Season Unknown",
-                            "IndexNumber": 0,
-                            "ParentId": series_id,
-                            "ImageUrl": None
-                        }
-                        seasons_by_show[series_id].append(pseudo_season)
-                    episodes_by_season[pseudo_season_id].append(item)
-                else:
-                    continue
-            else:
-                episodes_by_season[season_id].append(item)
+        yield item.replace(ImageUrl=make_image_url(item))
 
-    for seasons in seasons_by_show.values():
-        seasons.sort(key=lambda s: s.get("IndexNumber") or 0)
 
-    for eps in episodes_by_season.values():
-        eps.sort(key=lambda e: (e.get("ParentIndexNumber") or 0, e.get("IndexNumber") or 0))
+def render_listing(template, pager, **context):
+    """
+    Renders a page of a listing. Large pages are streamed, so the first cards
+    reach the browser while the rest are still being decorated.
+    """
+    if pager["per_page"] > STREAM_THRESHOLD:
+        return app.response_class(stream_template(template, **pager, **context))
+    return render_template(template, **pager, **context)
 
-    return shows, seasons_by_show, episodes_by_season
+
+# =====================
+# Images
+# =====================
+
+# Resized copies of the server's images, see thumbnails.ThumbnailCache
+THUMBNAILS = ThumbnailCache(BASE_URL, API_KEY)
+
+
+@app.route("/img/<item_id>")
+def thumbnail(item_id):
+    tag = request.args.get("tag")
+    try:
+        path = THUMBNAILS.get(item_id, tag)
+    except ValueError:
+        abort(400)
+    except requests.RequestException as e:
+        print(f"Could not fetch image {item_id}:", e)
+        abort(502)
+    if path is None:
+        abort(404)
+
+    with open(path, "rb") as f:
+        mimetype = image_mimetype(f.read(12))
+    max_age = IMAGE_MAX_AGE if tag else UNTAGGED_IMAGE_MAX_AGE
+    response = send_file(path, mimetype=mimetype, max_age=max_age)
+    response.cache_control.public = True
+    response.cache_control.immutable = bool(tag)
+    return response
+
+
+# =====================
+# Response cache
+# =====================
+
+# Rendered pages of the read-only routes, see cached_page()
+PAGE_CACHE = ResponseCache()
+
+
+def cached_page(view):
+    """
+    Caches a read-only view's rendered page per URL (path and query string)
+    and snapshot version, since nothing else changes what it renders. Pages
+    carry an ETag and Last-Modified from the snapshot, so browsers that
+    already have this version get a 304 without a cache lookup or render.
+    Streamed pages and errors aren't cached.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        snapshot = CATALOGUE.snapshot
+        key = (snapshot.version, request.full_path)
+        etag = sha1(repr(key).encode("utf-8")).hexdigest()
+
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            entry = PAGE_CACHE.get(key)
+            if entry is not None:
+                response = app.response_class(entry[0], mimetype=entry[1])
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                # Only keep it if the snapshot didn't change while rendering
+                if not response.is_streamed and CATALOGUE.snapshot is snapshot:
+                    PAGE_CACHE.put(key, response.get_data(), response.mimetype)
+
+        response.set_etag(etag)
+        response.last_modified = snapshot.modified
+        response.cache_control.no_cache = True  # always revalidate, a new snapshot can land any time
+        return response.make_conditional(request)
+    return wrapper
 
 
 # =====================
@@ -97,10 +292,12 @@ def organize_items(items):
 # =====================
 
 @app.route("/")
+@cached_page
 def libraries():
+    # Only the manifest, so this page never loads a library
     filtered_libraries = {
-        name: lib for name, lib in LIBRARIES.items()
-        if lib.get("CollectionType") != "playlists" and lib.get("Items") and len(lib["Items"]) > 0
+        name: info for name, info in CATALOGUE.snapshot.info.items()
+        if info["CollectionType"] != "playlists" and info["Count"]
     }
     return render_template(
         "libraries.html",
@@ -108,178 +305,136 @@ def libraries():
     )
 
 
+def run_search():
+    """Runs the request's ?q= (with optional comma separated ?type= and ?library= filters)"""
+    snapshot = CATALOGUE.snapshot
+    query = request.args.get("q", "").strip()
+    types = set(filter(None, request.args.get("type", "").split(",")))
+    library_names = set(filter(None, request.args.get("library", "").split(",")))
+    limit = min(max(request.args.get("limit", SEARCH_LIMIT, type=int), 1), MAX_PER_PAGE)
+
+    hits, more = snapshot.search.search(query, types, library_names, limit)
+
+    results = []
+    for library_name, item in hits:
+        library = snapshot.library(library_name)
+        result = {
+            "Id": item["Id"],
+            "Name": item.get("Name"),
+            "Type": item.get("Type"),
+            "Library": library_name,
+            "Url": item_url(library, item),
+            "ImageUrl": cover_image_url(library)(item)
+        }
+        results.append(result)
+    return query, results, more
+
+
+@app.route("/search")
+def search():
+    query, results, more = run_search()
+    return render_template(
+        "search.html",
+        query=query,
+        results=results,
+        more=more,
+        libraries=CATALOGUE.snapshot.info
+    )
+
+
+@app.route("/api/search")
+def search_json():
+    query, results, more = run_search()
+    return jsonify(query=query, results=results, more=more)
+
+
 @app.route("/library/<library_name>")
+@cached_page
 def library(library_name):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    collection_type = library.get("CollectionType")
+    collection_type = library.collection_type
 
     if collection_type == "movies":
-        movies = [
-            i for i in items
-            if i.get("Type") == "Movie" and is_real_media(i)
-        ]
-        movies_with_images = []
-        for movie in movies:
-            movie_id = movie["Id"]
-            image_url = f"{BASE_URL}/Items/{movie_id}/Images/Primary?quality=90&api_key={API_KEY}"
-            movie_copy = dict(movie)
-            movie_copy["ImageUrl"] = image_url
-            movies_with_images.append(movie_copy)
-
-        return render_template(
+        movies, positions, sorting = sorted_view(library, "movies")
+        movies_page, pager = paginate(movies, positions)
+
+        return render_listing(
             "movies.html",
-            library_name=library_name,
-            movies=movies_with_images
+            movies=decorate(movies_page, primary_image_url),
+            pager=pager,
+            sorting=sorting,
+            library_name=library_name
         )
 
-
     elif collection_type == "tvshows":
-        shows, seasons_by_show, episodes_by_season = organize_items(items)
-
-        shows_with_images = []
-        for show_id, show in shows.items():
-            image_url = f"{BASE_URL}/Items/{show_id}/Images/Primary?quality=90&api_key={API_KEY}"
-            show_copy = dict(show)
-            show_copy["ImageUrl"] = image_url
-            shows_with_images.append(show_copy)
-
-        # Pagination
-        page = request.args.get('page', 1, type=int)
-        total_shows = len(shows_with_images)
-        total_pages = ceil(total_shows / ITEMS_PER_PAGE)
+        shows, positions, sorting = sorted_view(library, "shows")
+        shows_page, pager = paginate(shows, positions)
 
-        start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        shows_page = shows_with_images[start:end]
-
-        return render_template(
+        return render_listing(
             "show.html",
-            library_name=library_name,
-            shows=shows_page,
-            page=page,
-            total_pages=total_pages
+            shows=decorate(shows_page, primary_image_url),
+            pager=pager,
+            sorting=sorting,
+            library_name=library_name
         )
 
     elif collection_type == "books":
         # Show folders (book collections)
-        collections = [i for i in items if i.get("Type") == "Folder"]
-
-        collections_with_images = []
-        for collection in collections:
-            coll_copy = dict(collection)
+        collections, positions, sorting = sorted_view(library, "Folder")
+        collections_page, pager = paginate(collections, positions)
 
-            # Try to get image from collection's ImageTags (if any)
-            image_url = None
-            image_tag = collection.get("ImageTags", {}).get("Primary")
-            if image_tag:
-                image_url = f"{BASE_URL}/Items/{collection['Id']}/Images/Primary?tag={image_tag}&api_key={API_KEY}"
-            else:
-                # fallback: try to get first book's image inside this folder
-                first_book = next((b for b in items if b.get("Type") == "Book" and b.get("ParentId") == collection["Id"]), None)
-                if first_book:
-                    book_image_tag = first_book.get("ImageTags", {}).get("Primary")
-                    if book_image_tag:
-                        image_url = f"{BASE_URL}/Items/{first_book['Id']}/Images/Primary?tag={book_image_tag}&api_key={API_KEY}"
-
-            coll_copy["ImageUrl"] = image_url
-            collections_with_images.append(coll_copy)
-
-        # Pagination
-        page = request.args.get('page', 1, type=int)
-        total_collections = len(collections_with_images)
-        total_pages = ceil(total_collections / ITEMS_PER_PAGE)
-
-        start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        collections_page = collections_with_images[start:end]
-
-        return render_template(
+        return render_listing(
             "book_collections.html",
-            library_name=library_name,
-            collections=collections_page,
-            page=page,
-            total_pages=total_pages
+            collections=decorate(collections_page, cover_image_url(library)),
+            pager=pager,
+            sorting=sorting,
+            library_name=library_name
         )
 
     elif collection_type == "music":
         # Show music albums or artists
-        albums = [i for i in items if i.get("Type") == "MusicAlbum"]
-        albums_with_images = []
-        for album in albums:
-            album_copy = dict(album)
-            image_tag = album.get("ImageTags", {}).get("Primary")
-            if image_tag:
-                image_url = f"{BASE_URL}/Items/{album['Id']}/Images/Primary?tag={image_tag}&api_key={API_KEY}"
-            else:
-                image_url = None  # explicitly set to None if no image
-            album_copy["ImageUrl"] = image_url
-            albums_with_images.append(album_copy)
+        albums, positions, sorting = sorted_view(library, "MusicAlbum")
+        albums_page, pager = paginate(albums, positions)
 
-        return render_template(
+        return render_listing(
             "music_albums.html",
-            library_name=library_name,
-            albums=albums_with_images
+            albums=decorate(albums_page, cover_image_url(library)),
+            pager=pager,
+            sorting=sorting,
+            library_name=library_name
         )
 
     elif collection_type == "musicvideos":
-        page = int(request.args.get("page", 1))
-        per_page = 100
-
-        folders = [i for i in items if i.get("Type") == "Folder"]
-
-        total = len(folders)
-        total_pages = (total + per_page - 1) // per_page
+        folders, positions, sorting = sorted_view(library, "Folder")
+        folders_page, pager = paginate(folders, positions)
 
-        start = (page - 1) * per_page
-        end = start + per_page
-        folders_page = folders[start:end]
-
-        folders_with_images = []
-        for folder in folders_page:
-            folder_copy = dict(folder)
-
-            image_tag = folder.get("ImageTags", {}).get("Primary")
-            if image_tag:
-                folder_copy["ImageUrl"] = (
-                    f"{BASE_URL}/Items/{folder['Id']}/Images/Primary"
-                    f"?tag={image_tag}&api_key={API_KEY}"
-                )
-            else:
-                folder_copy["ImageUrl"] = None
-
-            folders_with_images.append(folder_copy)
-
-        return render_template(
+        return render_listing(
             "music_video_folders.html",
-            library_name=library_name,
-            folders=folders_with_images,
-            page=page,
-            total_pages=total_pages
+            folders=decorate(folders_page, cover_image_url(library)),
+            pager=pager,
+            sorting=sorting,
+            library_name=library_name
         )
 
-
-
-
     else:
         abort(404)
 
 @app.route("/album/<library_name>/<album_id>")
+@cached_page
 def album(library_name, album_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    album = next((a for a in items if a.get("Id") == album_id and a.get("Type") == "MusicAlbum"), None)
+    album = library.get(album_id, "MusicAlbum")
     if not album:
         abort(404)
 
     # You could list songs inside the album here if you want
-    songs = [i for i in items if i.get("Type") == "Audio" and i.get("ParentId") == album_id]
+    songs = library.children_of(album_id, "Audio")
 
     return render_template(
         "album.html",
@@ -290,108 +445,65 @@ def album(library_name, album_id):
 
 
 @app.route("/books/<library_name>/<collection_id>")
+@cached_page
 def book_collection(library_name, collection_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-
     # Get all books inside the collection folder
-    books = []
-    for item in items:
-        if item.get("Type") == "Book" and item.get("ParentId") == collection_id:
-            book_copy = dict(item)
-            image_tag = item.get("ImageTags", {}).get("Primary")
-            if image_tag:
-                book_copy["ImageUrl"] = f"{BASE_URL}/Items/{item['Id']}/Images/Primary?tag={image_tag}&api_key={API_KEY}"
-            else:
-                book_copy["ImageUrl"] = None
-            books.append(book_copy)
-
+    books = library.children_of(collection_id, "Book")
     if not books:
         abort(404)
 
     # Optionally get collection folder name for title
-    collection = next((c for c in items if c.get("Id") == collection_id), None)
+    collection = library.get(collection_id)
     if not collection:
         abort(404)
 
-    return render_template(
+    books_page, pager = paginate(books)
+
+    return render_listing(
         "books.html",
+        books=decorate(books_page, tagged_image_url),
+        pager=pager,
         library_name=library_name,
-        collection=collection,
-        books=books
+        collection=collection
     )
 
 
 
 @app.route("/music-videos/<library_name>/<folder_id>")
+@cached_page
 def music_video_folder(library_name, folder_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-
-    folder = next(
-        (i for i in items if i.get("Id") == folder_id and i.get("Type") == "Folder"),
-        None
-    )
+    folder = library.get(folder_id, "Folder")
     if not folder:
         abort(404)
 
-    videos = [
-        i for i in items
-        if i.get("Type") in ("MusicVideo", "Video")
-        and i.get("ParentId") == folder_id
-    ]
-
-    # Pagination setup
-    page = int(request.args.get("page", 1))
-    per_page = 100
-    total = len(videos)
-    total_pages = (total + per_page - 1) // per_page
-
-    start = (page - 1) * per_page
-    end = start + per_page
-    videos_page = videos[start:end]
-
-    videos_with_images = []
-    for video in videos_page:
-        video_copy = dict(video)
-        tag = video.get("ImageTags", {}).get("Primary")
-        if tag:
-            video_copy["ImageUrl"] = (
-                f"{BASE_URL}/Items/{video['Id']}/Images/Primary"
-                f"?tag={tag}&api_key={API_KEY}"
-            )
-        else:
-            video_copy["ImageUrl"] = None
-        videos_with_images.append(video_copy)
+    videos = library.children_of(folder_id, "MusicVideo", "Video")
+    videos_page, pager = paginate(videos)
 
-    return render_template(
+    return render_listing(
         "music_videos.html",
+        videos=decorate(videos_page, tagged_image_url),
+        pager=pager,
         library_name=library_name,
-        folder=folder,
-        videos=videos_with_images,
-        page=page,
-        total_pages=total_pages
+        folder=folder
     )
 
 
 
 @app.route("/music-video/<library_name>/<video_id>")
 def music_video(library_name, video_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    video = next(
-        (v for v in items if v.get("Id") == video_id and v.get("Type") == "MusicVideo"),
-        None
-    )
+    video = library.get(video_id, "MusicVideo")
     if not video:
         abort(404)
 
@@ -404,13 +516,13 @@ def music_video(library_name, video_id):
 
 
 @app.route("/show/<library_name>/<show_id>")
+@cached_page
 def show(library_name, show_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    shows, seasons_by_show, episodes_by_season = organize_items(items)
+    shows, seasons_by_show, episodes_by_season = library.hierarchy()
 
     show_obj = shows.get(show_id)
     if not show_obj:
@@ -420,22 +532,11 @@ def show(library_name, show_id):
     if not seasons:
         abort(404)
 
-    seasons_with_images = []
-    for season in seasons:
-        season_id = season.get("Id")
-        episodes = episodes_by_season.get(season_id, [])
-        episodes_with_container = [ep for ep in episodes if ep.get("Container")]
-        if not episodes_with_container:
-            continue
-
-        image_tag = season.get("ImageTags", {}).get("Primary")
-        image_url = None
-        if image_tag:
-            image_url = f"{BASE_URL}/Items/{season['Id']}/Images/Primary?tag={image_tag}&api_key={API_KEY}"
-
-        season_copy = dict(season)
-        season_copy["ImageUrl"] = image_url
-        seasons_with_images.append(season_copy)
+    seasons_with_episodes = [
+        season for season in seasons
+        if any(ep.get("Container") for ep in episodes_by_season.get(season.get("Id"), []))
+    ]
+    seasons_with_images = list(decorate(seasons_with_episodes, cover_image_url(library)))
 
     if not seasons_with_images:
         abort(404)
@@ -449,14 +550,11 @@ def show(library_name, show_id):
 
 @app.route("/download/music-video/<library_name>/<video_id>")
 def download_music_video(library_name, video_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    video = next(
-        (v for v in library["Items"] if v.get("Id") == video_id),
-        None
-    )
+    video = library.get(video_id)
     if not video:
         abort(404)
 
@@ -480,12 +578,12 @@ def download_album(library_name, album_id):
 @app.route("/download/song/<library_name>/<song_id>")
 def download_song(library_name, song_id):
     # Find the song item in the library by song_id and library_name
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
     # Find the song in the items
-    song = next((item for item in library["Items"] if item.get("Id") == song_id and item.get("Type") == "Audio"), None)
+    song = library.get(song_id, "Audio")
     if not song:
         abort(404)
 
@@ -509,21 +607,15 @@ def download_book_collection(library_name, collection_id):
 
 
 @app.route("/season/<library_name>/<season_id>")
+@cached_page
 def season(library_name, season_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    shows, seasons_by_show, episodes_by_season = organize_items(items)
-
-    season_info = None
-    for seasons in seasons_by_show.values():
-        for s in seasons:
-            if s["Id"] == season_id:
-                season_info = s
-                break
+    shows, seasons_by_show, episodes_by_season = library.hierarchy()
 
+    season_info, show_id = library.find_season(season_id)
     if not season_info:
         abort(404)
 
@@ -533,14 +625,7 @@ def season(library_name, season_id):
 
     episodes_with_images = []
     for ep in episodes:
-        image_tag = ep.get("ImageTags", {}).get("Primary")
-        image_url = None
-        if image_tag:
-            image_url = f"{BASE_URL}/Items/{ep['Id']}/Images/Primary?tag={image_tag}&api_key={API_KEY}"
-
-        ep_copy = dict(ep)
-        ep_copy["ImageUrl"] = image_url
-        episodes_with_images.append(ep_copy)
+        episodes_with_images.append(ep.replace(ImageUrl=tagged_image_url(ep)))
 
     return render_template(
         "episodes.html",
@@ -551,12 +636,11 @@ def season(library_name, season_id):
 
 @app.route("/download/show/<library_name>/<show_id>")
 def download_show(library_name, show_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    shows, seasons_by_show, episodes_by_season = organize_items(items)
+    shows, seasons_by_show, episodes_by_season = library.hierarchy()
 
     if show_id not in shows:
         abort(404)
@@ -573,26 +657,18 @@ def download_show(library_name, show_id):
 
 @app.route("/download/season/<library_name>/<season_id>")
 def download_season(library_name, season_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    shows, seasons_by_show, episodes_by_season = organize_items(items)
-
-    season_info = None
-    show_id = None
-    for sid, seasons in seasons_by_show.items():
-        for s in seasons:
-            if s["Id"] == season_id:
-                season_info = s
-                show_id = sid
-                break
+    shows, seasons_by_show, episodes_by_season = library.hierarchy()
+    season_index, episode_index = library.reverse_index()
 
+    season_info, show_id = library.find_season(season_id)
     if not season_info:
         abort(404)
 
-    download_season_background(season_id, shows, seasons_by_show, episodes_by_season)
+    download_season_background(season_id, shows, season_index, episodes_by_season)
 
     name = f"{shows[show_id]['Name']} – Season {season_info.get('IndexNumber', '?')}"
 
@@ -606,27 +682,13 @@ def download_season(library_name, season_id):
 
 @app.route("/download/episode/<library_name>/<episode_id>")
 def download_episode(library_name, episode_id):
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
 
-    items = library["Items"]
-    shows, seasons_by_show, episodes_by_season = organize_items(items)
-
-    episode = None
-    season_id = None
-    show_id = None
-
-    for sid, seasons in seasons_by_show.items():
-        for s in seasons:
-            eps = episodes_by_season.get(s["Id"], [])
-            for ep in eps:
-                if ep["Id"] == episode_id:
-                    episode = ep
-                    season_id = s["Id"]
-                    show_id = sid
-                    break
+    shows, seasons_by_show, episodes_by_season = library.hierarchy()
 
+    episode, season_id, show_id = library.find_episode(episode_id)
     if not episode:
         abort(404)
 
@@ -649,12 +711,11 @@ def download_episode(library_name, episode_id):
 def download_movie(library_name, movie_id):
     # You need to implement this function for downloading movies
     # Example:
-    library = LIBRARIES.get(library_name)
+    library = CATALOGUE.get(library_name)
     if not library:
         abort(404)
-    
-    items = library["Items"]
-    movie = next((i for i in items if i.get("Id") == movie_id and i.get("Type") == "Movie"), None)
+
+    movie = library.get(movie_id, "Movie")
     if not movie:
         abort(404)
 
@@ -669,5 +730,47 @@ def download_movie(library_name, movie_id):
     )
 
 
+# =====================
+# Download progress
+# =====================
+
+# The download queue and its progress live in this process (see download.py).
+# Under several worker processes each one would have its own queue and cap and
+# /downloads would only show the jobs of whichever worker answered, so
+# downloads need the app served by a single process.
+
+@app.route("/downloads")
+def downloads():
+    return render_template("downloads.html", progress=PROGRESS.snapshot())
+
+
+@app.route("/api/downloads")
+def downloads_json():
+    return jsonify(PROGRESS.snapshot())
+
+
+@app.route("/downloads/events")
+def download_events():
+    """
+    Server-Sent Events stream of the download progress snapshot. Each stream
+    ends after PROGRESS_EVENT_LIFETIME, EventSource reconnects on its own, so
+    a tab left open doesn't hold a server thread forever.
+    """
+    def events():
+        yield "retry: 1000\n\n"
+        version = None
+        ends = time.monotonic() + PROGRESS_EVENT_LIFETIME
+        while time.monotonic() < ends:
+            version = PROGRESS.wait(version, timeout=PROGRESS_EVENT_TIMEOUT)
+            yield f"data: {json.dumps(PROGRESS.snapshot())}\n\n"
+            time.sleep(PROGRESS_EVENT_INTERVAL)
+
+    return app.response_class(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 if __name__ == "__main__":
     app.run(debug=True)
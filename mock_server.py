@@ -0,0 +1,336 @@
+"""
+Stand-in Jellyfin server for benchmarking api.py and download.py offline.
+
+Implements just what the scraper and downloader use: /Users, /Users/{id}/Views,
+/Users/{id}/Items (paging, IncludeItemTypes, MinDateLastSaved), /Items/{id}/Download
+(with Range) and /Items/{id}/Images/Primary. Libraries are synthetic and generated
+from their index on the fly, so a multi-million item server costs no memory.
+
+    python mock_server.py --port 8096 --movies 50000 --latency 20 --bandwidth 10
+"""
+
+import argparse
+import json
+import re
+import struct
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+USER_ID = "b0000000000000000000000000000001"
+USERNAME = "bench"
+API_KEY = "bench"
+DATE_SAVED = "2026-01-01T00:00:00.0000000Z"
+
+CHUNK_SIZE = 64 * 1024
+PATTERN = bytes(range(256)) * (CHUNK_SIZE // 256)
+
+
+# =====================
+# Synthetic libraries
+# =====================
+
+def make_id(library, kind, index):
+    return f"{library:02x}{kind:02x}{index:028x}"
+
+
+class Segment:
+    """
+    A run of `count` items of one Type. `make(i)` builds the i-th item,
+    so items never have to exist until they're asked for.
+    """
+
+    def __init__(self, item_type, count, make):
+        self.item_type = item_type
+        self.count = count
+        self.make = make
+
+
+def build_libraries(config):
+    movies, shows, seasons, episodes = (
+        config.movies, config.shows, config.seasons_per_show, config.episodes_per_season
+    )
+    albums, tracks = config.albums, config.tracks_per_album
+    book_folders, books = config.book_folders, config.books_per_folder
+    video_folders, videos = config.video_folders, config.videos_per_folder
+
+    def base(library, kind, index, item_type, name, **fields):
+        item = {
+            "Name": name,
+            "Id": make_id(library, kind, index),
+            "Type": item_type,
+            "ImageTags": {"Primary": f"{index:08x}"},
+            "LocationType": "FileSystem",
+            "DateLastSaved": DATE_SAVED,
+            "DateCreated": f"2025-{index % 12 + 1:02d}-{index % 28 + 1:02d}T00:00:00.0000000Z",
+        }
+        item.update(fields)
+        return item
+
+    def media(path, container="mkv", media_type="Video"):
+        return {"Path": path, "Container": container, "MediaType": media_type}
+
+    def movie(i):
+        return base(1, 1, i, "Movie", f"Movie {i}", ParentId=make_id(1, 0, 0),
+                    **media(f"/media/movies/Movie {i}.mkv"))
+
+    def series(i):
+        return base(2, 1, i, "Series", f"Show {i}", ParentId=make_id(2, 0, 0))
+
+    def season(i):
+        show, number = divmod(i, seasons)
+        return base(2, 2, i, "Season", f"Season {number + 1}", ParentId=make_id(2, 1, show),
+                    IndexNumber=number + 1, SeriesId=make_id(2, 1, show))
+
+    def episode(i):
+        season_index, number = divmod(i, episodes)
+        show = season_index // seasons
+        return base(
+            2, 3, i, "Episode", f"Episode {number + 1}",
+            ParentId=make_id(2, 2, season_index),
+            SeasonId=make_id(2, 2, season_index),
+            SeriesId=make_id(2, 1, show),
+            IndexNumber=number + 1,
+            ParentIndexNumber=season_index % seasons + 1,
+            **media(f"/media/tv/Show {show}/S{season_index % seasons + 1:02d}E{number + 1:02d}.mkv")
+        )
+
+    def album(i):
+        return base(3, 1, i, "MusicAlbum", f"Album {i}", ParentId=make_id(3, 0, 0))
+
+    def track(i):
+        album_index, number = divmod(i, tracks)
+        return base(3, 2, i, "Audio", f"Track {number + 1}",
+                    ParentId=make_id(3, 1, album_index), AlbumId=make_id(3, 1, album_index),
+                    IndexNumber=number + 1,
+                    **media(f"/media/music/Album {album_index}/{number + 1:02d}.flac", "flac", "Audio"))
+
+    def book_folder(i):
+        return base(4, 1, i, "Folder", f"Collection {i}", ParentId=make_id(4, 0, 0))
+
+    def book(i):
+        folder, number = divmod(i, books)
+        return base(4, 2, i, "Book", f"Book {number + 1}", ParentId=make_id(4, 1, folder),
+                    **media(f"/media/books/Collection {folder}/Book {number + 1}.epub", "epub", "Book"))
+
+    def video_folder(i):
+        return base(5, 1, i, "Folder", f"Artist {i}", ParentId=make_id(5, 0, 0))
+
+    def video(i):
+        folder, number = divmod(i, videos)
+        return base(5, 2, i, "MusicVideo", f"Video {number + 1}", ParentId=make_id(5, 1, folder),
+                    **media(f"/media/musicvideos/Artist {folder}/Video {number + 1}.mp4", "mp4"))
+
+    libraries = [
+        ("Movies", "movies", [Segment("Movie", movies, movie)]),
+        ("Shows", "tvshows", [
+            Segment("Series", shows, series),
+            Segment("Season", shows * seasons, season),
+            Segment("Episode", shows * seasons * episodes, episode),
+        ]),
+        ("Music", "music", [
+            Segment("MusicAlbum", albums, album),
+            Segment("Audio", albums * tracks, track),
+        ]),
+        ("Books", "books", [
+            Segment("Folder", book_folders, book_folder),
+            Segment("Book", book_folders * books, book),
+        ]),
+        ("Music Videos", "musicvideos", [
+            Segment("Folder", video_folders, video_folder),
+            Segment("MusicVideo", video_folders * videos, video),
+        ]),
+    ]
+    return {
+        make_id(n, 0, 0): {"Name": name, "CollectionType": collection_type, "Segments": segments}
+        for n, (name, collection_type, segments) in enumerate(libraries, start=1)
+    }
+
+
+def query_items(library, include_types, min_date, start, limit):
+    segments = [
+        s for s in library["Segments"]
+        if not include_types or s.item_type in include_types
+    ]
+    # Every synthetic item was saved at DATE_SAVED
+    if min_date and min_date > DATE_SAVED:
+        segments = []
+
+    total = sum(s.count for s in segments)
+    items = []
+    offset = 0
+    for s in segments:
+        if len(items) >= limit:
+            break
+        first = max(start - offset, 0)
+        last = min(start + limit - offset, s.count)
+        items.extend(s.make(i) for i in range(first, last))
+        offset += s.count
+
+    return {"Items": items, "TotalRecordCount": total, "StartIndex": start}
+
+
+def make_png(width, height, rgb):
+    row = b"\x00" + bytes(rgb) * width
+    raw = zlib.compress(row * height, 9)
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", raw)
+            + chunk(b"IEND", b""))
+
+
+# =====================
+# HTTP
+# =====================
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        config = self.server.config
+        if config.latency:
+            time.sleep(config.latency / 1000)
+
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        path = url.path
+
+        if path == "/Users":
+            return self.send_json([{"Name": USERNAME, "Id": USER_ID}])
+
+        if path == f"/Users/{USER_ID}/Views":
+            return self.send_json({"Items": [
+                {"Name": lib["Name"], "Id": lib_id, "CollectionType": lib["CollectionType"]}
+                for lib_id, lib in self.server.libraries.items()
+            ]})
+
+        if path == f"/Users/{USER_ID}/Items":
+            library = self.server.libraries.get(query.get("ParentId"))
+            if library is None:
+                return self.send_json({"Items": [], "TotalRecordCount": 0})
+            include_types = set(filter(None, query.get("IncludeItemTypes", "").split(",")))
+            return self.send_json(query_items(
+                library,
+                include_types,
+                query.get("MinDateLastSaved"),
+                int(query.get("StartIndex", 0)),
+                int(query.get("Limit", 100))
+            ))
+
+        if re.fullmatch(r"/Items/\w+/Download", path):
+            return self.send_file(config.file_size * 1024 * 1024)
+
+        if re.fullmatch(r"/Items/\w+/Images/Primary", path):
+            return self.send_bytes(self.server.image, "image/png")
+
+        self.send_error(404)
+
+    def send_json(self, data):
+        self.send_bytes(json.dumps(data).encode("utf-8"), "application/json")
+
+    def send_bytes(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, size):
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if not match.group(1):
+                start = max(size - int(match.group(2)), 0)
+            else:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        bandwidth = self.server.config.bandwidth * 1024 * 1024  # per connection
+        position = start
+        try:
+            while position <= end:
+                offset = position % len(PATTERN)
+                chunk = PATTERN[offset:offset + min(CHUNK_SIZE, end - position + 1)]
+                self.wfile.write(chunk)
+                position += len(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk) / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def make_server(config, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, config.port), Handler)
+    server.daemon_threads = True
+    server.config = config
+    server.libraries = build_libraries(config)
+    server.image = make_png(300, 450, (90, 60, 120))
+    return server
+
+
+def expected_file_bytes(offset, length):
+    """The exact bytes the server sends for a file range, for verifying downloads"""
+    out = bytearray()
+    while length:
+        start = offset % len(PATTERN)
+        chunk = PATTERN[start:start + length]
+        out += chunk
+        offset += len(chunk)
+        length -= len(chunk)
+    return bytes(out)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Synthetic Jellyfin server for benchmarks")
+    parser.add_argument("--port", type=int, default=8096)
+    parser.add_argument("--movies", type=int, default=2000)
+    parser.add_argument("--shows", type=int, default=200)
+    parser.add_argument("--seasons-per-show", type=int, default=3)
+    parser.add_argument("--episodes-per-season", type=int, default=10)
+    parser.add_argument("--albums", type=int, default=1000)
+    parser.add_argument("--tracks-per-album", type=int, default=12)
+    parser.add_argument("--book-folders", type=int, default=100)
+    parser.add_argument("--books-per-folder", type=int, default=20)
+    parser.add_argument("--video-folders", type=int, default=50)
+    parser.add_argument("--videos-per-folder", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=8, help="size of every downloadable file in MB")
+    parser.add_argument("--latency", type=float, default=0, help="added latency per request in ms")
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="per-connection download limit in MB/s (0 = unlimited)")
+    return parser
+
+
+def main():
+    config = build_parser().parse_args()
+    server = make_server(config)
+    print(f"Mock Jellyfin on http://127.0.0.1:{config.port} (user {USERNAME}, api key {API_KEY})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
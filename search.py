@@ -0,0 +1,105 @@
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def normalize(text):
+    """Casefolds and strips accents, so "Amélie" and "amelie" index the same"""
+    if text.isascii():
+        return text.casefold()
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text or ""))
+
+
+# =====================
+# Inverted index
+# =====================
+
+class SearchIndex:
+    """
+    Name search over every item of every library, built once per snapshot.
+
+    Each item is a document number; every Name token maps to the sorted
+    array of documents containing it. The sorted vocabulary lets the last
+    query word match as a prefix (find-as-you-type), while the other words
+    must match whole tokens. Queries walk the rarest posting list and stop
+    as soon as they have enough hits, so they never touch the whole index.
+    """
+
+    def __init__(self, libraries):
+        self.docs = []
+        postings = defaultdict(lambda: array("I"))
+
+        for library in libraries.values():
+            for item in library.items:
+                doc = len(self.docs)
+                self.docs.append((library.name, item))
+                for token in set(tokenize(item.get("Name"))):
+                    postings[token].append(doc)
+
+        self.postings = dict(postings)
+        self.vocabulary = sorted(self.postings)
+
+    def _prefix_tokens(self, prefix):
+        start = bisect_left(self.vocabulary, prefix)
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def search(self, query, types=None, libraries=None, limit=50):
+        """
+        Items whose Name has every word of the query, the last one as a
+        prefix. Optionally restricted to some item Types and library names.
+        Returns ([(library name, item), ...], more) where `more` says
+        whether there are matches beyond `limit`.
+        """
+        words = tokenize(query)
+        if not words:
+            return [], False
+        whole, prefix = words[:-1], words[-1]
+
+        for word in whole:
+            if word not in self.postings:
+                return [], False
+
+        if whole:
+            # Walk the rarest whole word, check the rest against each name
+            candidates = min((self.postings[word] for word in whole), key=len)
+        else:
+            candidates = self._prefix_candidates(prefix)
+
+        results = []
+        for doc in candidates:
+            library_name, item = self.docs[doc]
+            if types and item.get("Type") not in types:
+                continue
+            if libraries and library_name not in libraries:
+                continue
+            if whole:
+                tokens = tokenize(item.get("Name"))
+                if not all(word in tokens for word in whole):
+                    continue
+                if not any(token.startswith(prefix) for token in tokens):
+                    continue
+            if len(results) == limit:
+                return results, True
+            results.append((library_name, item))
+        return results, False
+
+    def _prefix_candidates(self, prefix):
+        """Documents with a token starting with `prefix`: exact token first, then longer ones"""
+        seen = set()
+        for token in self._prefix_tokens(prefix):
+            for doc in self.postings[token]:
+                if doc not in seen:
+                    seen.add(doc)
+                    yield doc
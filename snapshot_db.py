@@ -0,0 +1,453 @@
+"""
+Read-only SQLite copy of a catalogue snapshot, for serving from several
+worker processes.
+
+Every item, listing order, cover, TV hierarchy and the search index are
+written to one database file once; each worker maps it read-only, so N
+workers share a single page-cache copy instead of parsing and holding the
+catalogue N times. api.py rebuilds it after every scrape once it exists:
+
+    python snapshot_db.py              # build catalogue.db from scrape/ or all_items.json
+    gunicorn -w 4 --threads 8 main:app
+
+Downloads don't share across processes: each worker would run its own
+download queue, with its own concurrency cap, and /downloads would show only
+that worker's jobs. Serve with a single process (-w 1) when using downloads.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+from catalogue import (
+    Item, LISTINGS, SORT_KEYS, file_version, library_info, load_snapshot, open_snapshot
+)
+from search import tokenize
+
+DATABASE_FILE = "catalogue.db"
+MMAP_SIZE = 0x7FFF0000  # SQLite's default mmap ceiling; beyond it pages go through read()
+
+SCHEMA = """
+CREATE TABLE libraries (
+    position INTEGER PRIMARY KEY,
+    name TEXT, library_id TEXT, collection_type TEXT, count INTEGER
+);
+CREATE TABLE items (
+    rowid INTEGER PRIMARY KEY,
+    library INTEGER, id TEXT, type TEXT, parent_id TEXT, data TEXT
+);
+CREATE TABLE listings (
+    library INTEGER, listing TEXT, sort TEXT, position INTEGER, item INTEGER, container TEXT,
+    PRIMARY KEY (library, listing, sort, position)
+) WITHOUT ROWID;
+CREATE TABLE covers (
+    library INTEGER, item_id TEXT, image_id TEXT, tag TEXT,
+    PRIMARY KEY (library, item_id)
+) WITHOUT ROWID;
+CREATE TABLE seasons (
+    library INTEGER, show_id TEXT, position INTEGER, season_id TEXT, data TEXT,
+    PRIMARY KEY (library, show_id, position)
+) WITHOUT ROWID;
+CREATE TABLE episodes (
+    library INTEGER, season_id TEXT, position INTEGER, item INTEGER,
+    PRIMARY KEY (library, season_id, position)
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE search USING fts5(name, content='', tokenize='unicode61 remove_diacritics 2');
+"""
+
+# Created after the bulk insert, that's much faster than keeping them up to date
+INDEXES = """
+CREATE INDEX items_id ON items (library, id);
+CREATE INDEX items_parent ON items (library, parent_id);
+CREATE INDEX listings_item ON listings (library, listing, sort, item);
+CREATE INDEX listings_container ON listings (library, listing, sort, container, position);
+CREATE INDEX seasons_id ON seasons (library, season_id);
+CREATE INDEX episodes_item ON episodes (library, item);
+"""
+
+
+def decode(data):
+    return Item(json.loads(data).items())
+
+
+# =====================
+# Building
+# =====================
+
+def build_database(snapshot, path=DATABASE_FILE):
+    """
+    Writes a catalogue.Snapshot to a new database and swaps it in with an
+    atomic rename, so workers that still have the old file open keep
+    reading a consistent old version. Libraries are loaded, written and
+    released one at a time, so only one is in memory at once.
+    """
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    db = sqlite3.connect(tmp)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.executescript(SCHEMA)
+
+    for index, name in enumerate(snapshot.info):
+        library = snapshot.library(name)
+        db.execute(
+            "INSERT INTO libraries VALUES (?, ?, ?, ?, ?)",
+            (index, name, library.library_id, library.collection_type, len(library.items))
+        )
+
+        rowids = {}
+        for item in library.items:
+            cursor = db.execute(
+                "INSERT INTO items (library, id, type, parent_id, data) VALUES (?, ?, ?, ?, ?)",
+                (index, item["Id"], item.get("Type"), item.get("ParentId"),
+                 json.dumps(dict(item), ensure_ascii=False))
+            )
+            rowids[item["Id"]] = cursor.lastrowid
+            db.execute("INSERT INTO search (rowid, name) VALUES (?, ?)", (cursor.lastrowid, item.get("Name") or ""))
+
+        # Every listing in every order, so a page is a range read
+        for key in LISTINGS:
+            for sort in (None, *SORT_KEYS):
+                _, items = library.sorted_listing(key, sort)
+                db.executemany("INSERT INTO listings VALUES (?, ?, ?, ?, ?, ?)", (
+                    (index, key, sort or "", position, rowids[item["Id"]], item.get("Container"))
+                    for position, item in enumerate(items)
+                ))
+
+        shows, seasons_by_show, episodes_by_season = library.hierarchy()
+        for show_id, seasons in seasons_by_show.items():
+            db.executemany("INSERT INTO seasons VALUES (?, ?, ?, ?, ?)", (
+                (index, show_id, position, season["Id"], json.dumps(dict(season), ensure_ascii=False))
+                for position, season in enumerate(seasons)
+            ))
+        for season_id, episodes in episodes_by_season.items():
+            db.executemany("INSERT INTO episodes VALUES (?, ?, ?, ?)", (
+                (index, season_id, position, rowids[ep["Id"]])
+                for position, ep in enumerate(episodes)
+            ))
+
+        covers = dict(library.covers())
+        # Pseudo seasons aren't items, store the cover they borrow
+        for seasons in seasons_by_show.values():
+            for season in seasons:
+                cover = library.cover(season)
+                if cover and season["Id"] not in covers:
+                    covers[season["Id"]] = cover
+        db.executemany("INSERT INTO covers VALUES (?, ?, ?, ?)", (
+            (index, item_id, image_id, tag) for item_id, (image_id, tag) in covers.items()
+        ))
+        snapshot.release(name)
+
+    db.executescript(INDEXES)
+    db.execute("ANALYZE")
+    db.commit()
+    db.close()
+    os.replace(tmp, path)
+
+
+# =====================
+# Serving
+# =====================
+
+class Database:
+    """
+    One read-only, memory-mapped connection to a database file, shared by
+    the threads of a worker. It stays on the file it opened even after a
+    rebuild replaces the path.
+    """
+
+    def __init__(self, path):
+        uri = f"file:{quote(os.path.abspath(path))}?mode=ro&immutable=1"
+        self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        self._lock = threading.Lock()
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def value(self, sql, params=()):
+        rows = self.query(sql, params)
+        return rows[0][0] if rows else None
+
+
+class QueryMapping:
+    """Read-only stand-in for the dicts of an in-memory Library, `lookup` returns None for missing keys"""
+
+    def __init__(self, lookup):
+        self._lookup = lookup
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+
+class DbListing:
+    """
+    A stored listing order, read a slice at a time: len() and [start:end]
+    like the list an in-memory Library returns, without loading the rest.
+    """
+
+    def __init__(self, library, listing, sort, descending=False, container=None):
+        self.db = library.db
+        self.where = "listings.library = ? AND listing = ? AND sort = ?"
+        self.params = (library.index, listing, sort or "")
+        if container:
+            self.where += " AND listings.container = ?"
+            self.params += (container,)
+        self.filtered = bool(container)
+        self.descending = descending
+        self._length = None
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self.db.value(f"SELECT count(*) FROM listings WHERE {self.where}", self.params)
+        return self._length
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            items = self[index:index + 1 or None] if index >= 0 else self[len(self) + index:][:1]
+            if not items:
+                raise IndexError(index)
+            return items[0]
+
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("DbListing slices can't have a step")
+        if start >= stop:
+            return []
+
+        order = "DESC" if self.descending else ""
+        if self.filtered:
+            # Positions have gaps, walk the container index
+            sql = f"""SELECT items.data FROM listings JOIN items ON items.rowid = listings.item
+                      WHERE {self.where} ORDER BY position {order} LIMIT ? OFFSET ?"""
+            rows = self.db.query(sql, self.params + (stop - start, start))
+        else:
+            if self.descending:
+                start, stop = len(self) - stop, len(self) - start
+            sql = f"""SELECT items.data FROM listings JOIN items ON items.rowid = listings.item
+                      WHERE {self.where} AND position >= ? AND position < ? ORDER BY position {order}"""
+            rows = self.db.query(sql, self.params + (start, stop))
+        return [decode(data) for data, in rows]
+
+    def position(self, item_id, library_index):
+        """Index of the item in this view, or None"""
+        rowid = self.db.value("SELECT rowid FROM items WHERE library = ? AND id = ?", (library_index, item_id))
+        position = self.db.value(
+            f"SELECT position FROM listings WHERE {self.where} AND item = ?", self.params + (rowid,)
+        )
+        if position is None:
+            return None
+        if self.filtered:
+            compare = ">" if self.descending else "<"
+            return self.db.value(
+                f"SELECT count(*) FROM listings WHERE {self.where} AND position {compare} ?",
+                self.params + (position,)
+            )
+        return len(self) - 1 - position if self.descending else position
+
+
+class DbLibrary:
+    """
+    One library of a DbSnapshot with the same lookups as catalogue.Library,
+    answered by queries. Lists that can be long (listings) come back as
+    DbListings; the rest as plain lists of Items.
+    """
+
+    def __init__(self, db, index, name, info):
+        self.db = db
+        self.index = index
+        self.name = name
+        self.library_id = info["LibraryId"]
+        self.collection_type = info["CollectionType"]
+        self._containers = {}
+
+    def _items(self, sql, params, types=()):
+        return [decode(data) for item_type, data in self.db.query(sql, params) if not types or item_type in types]
+
+    def get(self, item_id, *types):
+        items = self._items("SELECT type, data FROM items WHERE library = ? AND id = ?", (self.index, item_id), types)
+        return items[0] if items else None
+
+    def children_of(self, parent_id, *types):
+        return self._items(
+            "SELECT type, data FROM items WHERE library = ? AND parent_id = ? ORDER BY rowid",
+            (self.index, parent_id), types
+        )
+
+    def cover(self, item):
+        rows = self.db.query(
+            "SELECT image_id, tag FROM covers WHERE library = ? AND item_id = ?", (self.index, item["Id"])
+        )
+        return tuple(rows[0]) if rows else None
+
+    def covers(self):
+        return {
+            item_id: (image_id, tag) for item_id, image_id, tag in
+            self.db.query("SELECT item_id, image_id, tag FROM covers WHERE library = ?", (self.index,))
+        }
+
+    def listing(self, key, build=None):
+        return DbListing(self, key, None)
+
+    def sorted_listing(self, key, sort, descending=False, container=None):
+        view_key = (key, sort, descending, container)
+        return view_key, DbListing(self, key, sort, descending, container)
+
+    def positions(self, key):
+        if not isinstance(key, tuple):
+            key = (key, None, False, None)
+        listing = DbListing(self, *key)
+        return QueryMapping(lambda item_id: listing.position(item_id, self.index))
+
+    def containers(self, key):
+        if key not in self._containers:
+            self._containers[key] = [container for container, in self.db.query(
+                """SELECT DISTINCT container FROM listings
+                   WHERE library = ? AND listing = ? AND sort = '' AND container IS NOT NULL
+                   ORDER BY container""",
+                (self.index, key)
+            )]
+        return self._containers[key]
+
+    def _seasons(self, show_id):
+        rows = self.db.query(
+            "SELECT data FROM seasons WHERE library = ? AND show_id = ? ORDER BY position", (self.index, show_id)
+        )
+        return [decode(data) for data, in rows] or None
+
+    def _episodes(self, season_id):
+        rows = self.db.query(
+            """SELECT items.data FROM episodes JOIN items ON items.rowid = episodes.item
+               WHERE episodes.library = ? AND season_id = ? ORDER BY position""",
+            (self.index, season_id)
+        )
+        return [decode(data) for data, in rows] or None
+
+    def hierarchy(self):
+        return (
+            QueryMapping(lambda show_id: self.get(show_id, "Series")),
+            QueryMapping(self._seasons),
+            QueryMapping(self._episodes),
+        )
+
+    def find_season(self, season_id):
+        rows = self.db.query(
+            "SELECT data, show_id FROM seasons WHERE library = ? AND season_id = ?", (self.index, season_id)
+        )
+        if not rows:
+            return None, None
+        return decode(rows[0][0]), rows[0][1]
+
+    def find_episode(self, episode_id):
+        rows = self.db.query(
+            """SELECT items.data, episodes.season_id, seasons.show_id FROM items
+               JOIN episodes ON episodes.library = items.library AND episodes.item = items.rowid
+               JOIN seasons ON seasons.library = items.library AND seasons.season_id = episodes.season_id
+               WHERE items.library = ? AND items.id = ?""",
+            (self.index, episode_id)
+        )
+        if not rows:
+            return None, None, None
+        data, season_id, show_id = rows[0]
+        return decode(data), season_id, show_id
+
+    def reverse_index(self):
+        def find_episode(episode_id):
+            episode, season_id, _ = self.find_episode(episode_id)
+            return (episode, season_id) if episode else None
+
+        def find_season(season_id):
+            season, show_id = self.find_season(season_id)
+            return (season, show_id) if season else None
+
+        return QueryMapping(find_season), QueryMapping(find_episode)
+
+
+class DbSearch:
+    """search.SearchIndex.search() answered by the database's full-text index"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def search(self, query, types=None, libraries=None, limit=50):
+        words = tokenize(query)
+        if not words:
+            return [], False
+        match = " ".join(f'"{word}"' for word in words) + "*"
+
+        names = list(self.snapshot.info)
+        sql = """SELECT items.library, items.data FROM search JOIN items ON items.rowid = search.rowid
+                 WHERE search MATCH ?"""
+        params = [match]
+        if types:
+            sql += f" AND items.type IN ({', '.join('?' * len(types))})"
+            params += list(types)
+        if libraries:
+            indexes = [names.index(name) for name in libraries if name in self.snapshot.info]
+            sql += f" AND items.library IN ({', '.join('?' * len(indexes))})"
+            params += indexes
+        sql += " ORDER BY search.rowid LIMIT ?"
+        params.append(limit + 1)
+
+        rows = self.snapshot.db.query(sql, params)
+        results = [(names[library], decode(data)) for library, data in rows[:limit]]
+        return results, len(rows) > limit
+
+
+class DbSnapshot:
+    """The catalogue.Snapshot interface over a database built by build_database()"""
+
+    def __init__(self, path, version, modified):
+        self.version = version
+        self.modified = modified
+        self.db = Database(path)
+        self.info = {
+            name: library_info(library_id, collection_type, count)
+            for name, library_id, collection_type, count in self.db.query(
+                "SELECT name, library_id, collection_type, count FROM libraries ORDER BY position"
+            )
+        }
+        self._libraries = {
+            name: DbLibrary(self.db, index, name, info) for index, (name, info) in enumerate(self.info.items())
+        }
+        self.search = DbSearch(self)
+
+    def library(self, name):
+        return self._libraries.get(name)
+
+    @property
+    def libraries(self):
+        return dict(self._libraries)
+
+
+def open_database(path, version=None):
+    return DbSnapshot(path, version or file_version(path), os.path.getmtime(path))
+
+
+def main():
+    manifest = os.path.join("scrape", "manifest.json")
+    if os.path.exists(manifest):
+        snapshot = open_snapshot(manifest)
+    else:
+        snapshot = load_snapshot("all_items.json")
+    build_database(snapshot)
+    print(f"Saved {len(snapshot.info)} libraries to {DATABASE_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Card-sized copies of Jellyfin's Primary images, kept on disk.
+
+The web app serves /img/<item_id> from here instead of hotlinking the
+server, so a grid page costs the server nothing once its images are cached
+and the API key never reaches the browser. Run after a scrape to warm the
+cache for every cover in all_items.json:
+
+    python thumbnails.py
+"""
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+THUMBNAIL_DIR = "thumbnails"
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+THUMBNAIL_WIDTH = 400  # cards are 200px wide, twice that for high-dpi screens
+THUMBNAIL_QUALITY = 85
+MAX_CONNECTIONS = 8
+PREFETCH_WORKERS = 4
+UNTAGGED_MAX_AGE = 24 * 3600  # without a tag we can't tell the image changed, so refetch now and then
+MISSING_MAX_AGE = 3600  # how long "the server has no image" is remembered
+
+SAFE_NAME = re.compile(r"\w+")
+
+
+def image_mimetype(head):
+    """Content type of an image from its first bytes (Jellyfin may ignore the format we ask for)"""
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:3] == b"GIF":
+        return "image/gif"
+    return "image/jpeg"
+
+
+class ThumbnailCache:
+    """
+    Resized Primary images as files named <item Id>-<image tag>, so a new
+    tag (the image changed on the server) is a new file and old ones just
+    age out. Files are evicted least recently used first once they add up
+    to more than `max_bytes`; the order survives restarts through mtimes.
+
+    Untagged images can change without their name changing, so they are
+    fetched again once older than UNTAGGED_MAX_AGE (their mtime is left at
+    the fetch time for that). Items the server has no image for are
+    remembered for MISSING_MAX_AGE instead of being asked for on every view.
+    """
+
+    def __init__(self, base_url, api_key, directory=THUMBNAIL_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.base_url = base_url
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+
+        self.session = requests.Session()
+        self.session.headers.update({"X-Emby-Token": api_key})
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
+
+        self.size = 0
+        self._files = OrderedDict()  # file name -> size, oldest use first
+        self._fetching = {}  # file name -> Lock, so each image is fetched once
+        self._missing = {}  # file name -> time.monotonic() until which the server has no image
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        entries = [e for e in os.scandir(directory) if e.is_file() and not e.name.endswith(".part")]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self._files[entry.name] = entry.stat().st_size
+            self.size += entry.stat().st_size
+
+    def file_name(self, item_id, tag=None):
+        if not SAFE_NAME.fullmatch(item_id) or (tag and not SAFE_NAME.fullmatch(tag)):
+            raise ValueError(f"Bad image key: {item_id} {tag}")
+        return f"{item_id}-{tag or 'untagged'}"
+
+    def get(self, item_id, tag=None):
+        """
+        Path of the cached thumbnail, fetched from the server first if needed.
+        Returns None if the server has no such image, raises
+        requests.RequestException if it can't be reached.
+        """
+        name = self.file_name(item_id, tag)
+        path = os.path.join(self.directory, name)
+
+        if self._touch(name, path, tag):
+            return path
+        if self._is_missing(name):
+            return None
+
+        with self._lock:
+            fetching = self._fetching.setdefault(name, threading.Lock())
+        with fetching:
+            # Someone else may have fetched it while we waited
+            if self._touch(name, path, tag):
+                return path
+            if self._is_missing(name):
+                return None
+            try:
+                if not self._fetch(item_id, tag, path):
+                    with self._lock:
+                        self._missing[name] = time.monotonic() + MISSING_MAX_AGE
+                    return None
+            finally:
+                with self._lock:
+                    self._fetching.pop(name, None)
+
+        self._add(name, os.path.getsize(path))
+        return path
+
+    def _is_missing(self, name):
+        with self._lock:
+            until = self._missing.get(name)
+            if until is not None and until <= time.monotonic():
+                del self._missing[name]
+                until = None
+        return until is not None
+
+    def _touch(self, name, path, tag=None):
+        """Marks a cached file as just used, False if it isn't cached (or untagged and too old)"""
+        with self._lock:
+            if name in self._files:
+                self._files.move_to_end(name)
+                known = True
+            else:
+                known = False
+        try:
+            modified = os.path.getmtime(path)
+        except FileNotFoundError:
+            if known:
+                self._remove(name)
+            return False
+        if not tag and time.time() - modified > UNTAGGED_MAX_AGE:
+            return False  # refetched over the old file, which stays counted until then
+        if not known:
+            # Written by another process (a prefetch run)
+            self._add(name, os.path.getsize(path))
+        if tag:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return True
+
+    def _fetch(self, item_id, tag, path):
+        params = {"maxWidth": THUMBNAIL_WIDTH, "quality": THUMBNAIL_QUALITY, "format": "Jpg"}
+        if tag:
+            params["tag"] = tag
+        response = self.session.get(
+            f"{self.base_url}/Items/{item_id}/Images/Primary", params=params, timeout=30
+        )
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+
+        part = path + ".part"
+        with open(part, "wb") as f:
+            f.write(response.content)
+        os.replace(part, path)
+        return True
+
+    def _add(self, name, size):
+        evicted = []
+        with self._lock:
+            self.size += size - self._files.pop(name, 0)
+            self._files[name] = size
+            while self.size > self.max_bytes and len(self._files) > 1:
+                old, old_size = self._files.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except FileNotFoundError:
+                pass
+
+    def _remove(self, name):
+        with self._lock:
+            self.size -= self._files.pop(name, 0)
+
+
+# =====================
+# Prefetch
+# =====================
+
+def prefetch(cache, snapshot, workers=PREFETCH_WORKERS):
+    """
+    Fetches every library cover of a catalogue.Snapshot that isn't cached
+    yet, reading one library at a time.
+    """
+    covers = set()
+    for name in snapshot.info:
+        covers.update(snapshot.library(name).covers().values())
+        snapshot.release(name)
+
+    def fetch(cover):
+        try:
+            return cache.get(*cover) is not None
+        except requests.RequestException as e:
+            print(f"Could not fetch image {cover[0]}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fetched = sum(pool.map(fetch, covers))
+    print(f"Thumbnails cached: {fetched} of {len(covers)}")
+
+
+def main():
+    from api import DATA_FILE, MANIFEST_FILE
+    from catalogue import load_snapshot, open_snapshot
+
+    with open("data.txt", "r") as file:
+        base_url = file.readline().strip()
+        api_key = file.readline().strip()
+
+    if os.path.exists(MANIFEST_FILE):
+        snapshot = open_snapshot(MANIFEST_FILE)
+    else:
+        snapshot = load_snapshot(DATA_FILE, search=False)
+    prefetch(ThumbnailCache(base_url, api_key), snapshot)
+
+
+if __name__ == "__main__":
+    main()